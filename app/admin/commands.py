@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""管理命令 通过 flask manage <命令> 调用"""
+import click
+
+from . import manage
+
+
+@manage.cli.command('import')
+@click.argument('path')
+@click.option('--kind', type=click.Choice(['case', 'bill']), required=True,
+              help='case: 案件信息表, bill: 起诉意见书')
+@click.option('--batch-size', default=1000, help='每批提交的行数')
+@click.option('--checkpoint', default=None, help='断点文件, 失败后重新运行会从这里继续')
+def import_command(path, kind, batch_size, checkpoint):
+    """从 JSONL/CSV 批量导入案件或起诉意见书"""
+    from ..bulk_import import bulk_import
+
+    def report(stats):
+        click.echo('已导入 %(rows)d 行 (新增 %(inserted)d, 更新 %(updated)d), '
+                   '%(rows_per_sec).1f 行/秒' % stats)
+
+    stats = bulk_import(path, kind, batch_size=batch_size,
+                        checkpoint=checkpoint, report=report)
+    click.echo('完成: %(rows)d 行, 用时 %(seconds).1f 秒' % stats)
+
+
+@manage.cli.command('search-reindex')
+def search_reindex_command():
+    """重建全文检索索引"""
+    from ..search import reindex
+    click.echo('已索引 %d 条记录' % reindex())
+
+
+@manage.cli.command('backfill-avatars')
+def backfill_avatars_command():
+    """把已有用户的头像改为保存邮箱hash"""
+    from ..models import User
+    click.echo('已更新 %d 个用户' % User.backfill_avatar_hash())
+
+
+@manage.cli.command('analyze-batch')
+@click.option('--kind', type=click.Choice(['case', 'bill']), default='case')
+@click.option('--workers', default=None, type=int, help='进程数, 默认为CPU核数')
+@click.option('--chunk-size', default=200, help='每次从数据库读取的行数')
+@click.option('--force', is_flag=True, help='已有结果的记录也重新分析')
+def analyze_batch_command(kind, workers, chunk_size, force):
+    """用进程池批量分析全部案件或起诉意见书"""
+    from flask import current_app
+    from ..analysis.batch import run_batch
+
+    def report(stats):
+        click.echo('进程 %(pid)d: 分析 %(analyzed)d, 跳过 %(skipped)d, 用时 %(seconds).1f 秒' % stats)
+
+    stats = run_batch(kind, current_app.config.get('ANALYSIS_DB_PATH', 'analysis.sqlite'),
+                      workers=workers, chunk_size=chunk_size, force=force, report=report)
+    click.echo('完成: %(workers)d 个进程, 分析 %(analyzed)d, 跳过 %(skipped)d, '
+               '用时 %(seconds).1f 秒, %(rows_per_sec).1f 行/秒' % stats)
+
+
+@manage.cli.command('recount-unread')
+def recount_unread_command():
+    """重新计算用户的未读信息数"""
+    from ..models import Info
+    Info.recount_unread()
+    click.echo('完成')
+
+
+@manage.cli.command('bench-passwords')
+@click.option('--method', 'methods', multiple=True,
+              default=['pbkdf2:sha256:50000', 'pbkdf2:sha256:150000', 'pbkdf2:sha256:260000'],
+              help='werkzeug的hash参数, 可以指定多个')
+@click.option('--seconds', default=1.0, help='每种参数测试的时间')
+def bench_passwords_command(methods, seconds):
+    """测试每种hash参数每秒能验证多少次"""
+    from ..passwords import benchmark
+    for row in benchmark(methods, seconds):
+        click.echo('%(method)-28s %(verifies_per_sec)10.1f 次/秒' % row)
+
+
+@manage.cli.command('changes-compact')
+@click.option('--retain-days', default=None, type=int,
+              help='超过这个天数的变更无论是否处理都删除')
+def changes_compact_command(retain_days):
+    """删除已经处理过的变更记录"""
+    from ..changefeed import compact
+    click.echo('已删除 %d 条变更记录' % compact(retain_days))
+
+
+@manage.cli.command('summary-refresh')
+@click.option('--rebuild', is_flag=True, help='清空后全量重建')
+def summary_refresh_command(rebuild):
+    """刷新案件汇总表 由一个定时任务运行, 不要多个进程同时运行"""
+    from .. import summary
+    if rebuild:
+        click.echo('已重建 %d 个案件的汇总' % summary.rebuild())
+    else:
+        click.echo('已处理 %d 条变更记录' % summary.refresh())
+
+
+@manage.cli.command('export')
+@click.argument('kind', type=click.Choice(['case', 'bill', 'comment', 'bilu']))
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv', 'parquet']), default='jsonl')
+@click.option('--output', '-o', default='-', help='输出文件, 默认输出到标准输出 (Parquet 必须指定文件)')
+@click.option('--status', default=None, help='记录状态, 默认只导出有效记录, all 导出全部')
+@click.option('--since', default=None, help='起始日期 (包含)')
+@click.option('--until', default=None, help='结束日期 (不包含)')
+@click.option('--chunk-size', default=1000, help='每次从数据库读取的行数')
+def export_command(kind, fmt, output, status, since, until, chunk_size):
+    """导出案件、起诉意见书、批注或笔录"""
+    from ..export import write_parquet, iter_export, ExportError
+    filters = {'status': status, 'since': since, 'until': until}
+    try:
+        if fmt == 'parquet':
+            if output == '-':
+                raise click.UsageError('Parquet 需要用 --output 指定文件')
+            click.echo('已导出 %d 行' % write_parquet(kind, output, chunk_size=chunk_size,
+                                                     **filters), err=True)
+            return
+        with click.open_file(output, 'w', encoding='utf-8') as f:
+            for text in iter_export(kind, fmt, chunk_size=chunk_size, **filters):
+                f.write(text)
+    except ExportError as e:
+        raise click.ClickException(str(e))
+
+
+@manage.cli.command('backfill-markdown')
+@click.option('--force', is_flag=True, help='已经渲染过的也重新渲染')
+@click.option('--batch-size', default=500, help='每批提交的行数')
+def backfill_markdown_command(force, batch_size):
+    """为已有的笔录和用户简介生成渲染后的HTML"""
+    from ..models import Bilu, User, backfill_markdown
+    click.echo('笔录: 已更新 %d 条' % backfill_markdown(
+        Bilu, 'body', 'body_html', batch_size=batch_size, force=force))
+    click.echo('用户简介: 已更新 %d 条' % backfill_markdown(
+        User, 'about_me', 'about_me_html', batch_size=batch_size, force=force))
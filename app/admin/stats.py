@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from flask import current_app
+
+from .. import db
+from ..models import User
+from ..cache import TTLCache
+
+_cache = TTLCache()
+_KEY = 'dashboard'
+
+
+def dashboard_stats():
+    """管理首页统计数据 用一条聚合查询得到, 缓存 DASHBOARD_STATS_TTL 秒"""
+    stats = _cache.get(_KEY)
+    if stats is not None:
+        return stats
+    row = db.session.query(
+        db.func.count(User.id),
+        db.func.sum(db.case([(User.confirmed == True, 1)], else_=0)),
+        db.func.sum(db.case([(User.is_admin == True, 1)], else_=0)),
+        db.func.count(User.disable_time),
+    ).one()
+    stats = {
+        'user_num': row[0] or 0,
+        'confirmed_num': int(row[1] or 0),
+        'admin_num': int(row[2] or 0),
+        'disabled_num': row[3] or 0,
+    }
+    _cache.set(_KEY, stats, ttl=current_app.config.get('DASHBOARD_STATS_TTL', 30))
+    return stats
+
+
+def invalidate_dashboard_stats(*args):
+    """用户增删后清除缓存"""
+    _cache.pop(_KEY)
+
+
+db.event.listen(User, 'after_insert', invalidate_dashboard_stats)
+db.event.listen(User, 'after_delete', invalidate_dashboard_stats)
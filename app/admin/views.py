@@ -1,25 +1,43 @@
 # -*- coding: utf-8 -*-
 
-import json
+import os
+import tempfile
 
-from flask import url_for, render_template, redirect, request, flash, session, jsonify
+from flask import url_for, render_template, redirect, request, flash, session, jsonify, abort, send_file
+from flask import Response, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
 
 from . import manage
 from .forms import AdminLoginForm
-from ..models import Administrator,User,Bilu
+from ..models import Administrator,Bilu,law_case_info,indictment_bill_info
 from ..decorators import super_admin_required
+from .. import db
+from ..cache import JsonFileCache
+from ..passwords import PasswordVerifyBusy
+from ..tokens import get_token_service
+from .stats import dashboard_stats
+from .. import search, changefeed  # changefeed 注册变更记录
+from .. import instrumentation, routing, summary, export
+from ..analysis import text_hash
+from ..analysis.jobs import ANALYSIS_TARGETS, get_manager
+from ..analysis.memo import get_cache
+from ..analysis.incremental import bilu_timeline
+from . import commands  # 注册 flask manage 命令
 
 from ..backend.matching import matching
 
+# 应用注册蓝本时按配置启用SQL统计, 配置连接池和副本
+manage.record_once(lambda state: instrumentation.init_app(state.app))
+manage.record_once(lambda state: routing.init_app(state.app))
+
+
 @manage.route('/')
 @login_required
 @super_admin_required
 def index():
     """管理页面首页"""
-    users = User.query.all()
-    user_num = len(users)
-    return render_template('admin/index.html', user_num=user_num )
+    stats = dashboard_stats()
+    return render_template('admin/index.html', **stats)
 
 
 @manage.route('/login', methods=["POST", "GET"])
@@ -29,7 +47,14 @@ def login():
     form = AdminLoginForm()
     if form.validate_on_submit():
         admin = Administrator.query.filter_by(username=form.username.data).first()
-        if admin is not None and admin.verify_password(form.password.data):
+        try:
+            verified = admin is not None and admin.verify_password(form.password.data)
+        except PasswordVerifyBusy:
+            flash('登录人数过多，请稍后再试')
+            return render_template('admin/login.html', form=form), 503
+        if verified:
+            # 密码重新hash后需要保存
+            db.session.commit()
             login_user(admin)
             return redirect(request.args.get('next') or url_for('manage.index'))
         flash('用户名或密码错误！')
@@ -77,58 +102,237 @@ def edit_bilu(id):
 def qisushuAnalyzingPage():
     return render_template("admin/qisushuAnalyzing/qisushuAnalyzing.html")
 
+def _send_json_file(path):
+    """直接把json文件分块发送给客户端, 支持 ETag/Last-Modified 条件请求和 Range 请求"""
+    return send_file(os.path.abspath(path), mimetype='application/json',
+                     conditional=True)
+
 @manage.route('/qisushuAnalyzing/timeline')
 @login_required
 @super_admin_required
 def timeline():
-    with open("app/demodata/timeline.json",'r',encoding="utf-8")as f:
-        data = f.read()
-    return jsonify(data)
+    return _send_json_file("app/demodata/timeline.json")
 
 @manage.route('/qisushuAnalyzing/text')
 @login_required
 @super_admin_required
 def text():
-    with open("app/demodata/text.json",'r',encoding="utf-8")as f:
-        data = f.read()
-    return jsonify(data)
+    return _send_json_file("app/demodata/text.json")
 
 
 ###笔录分析###
+def _bilu_index(data):
+    """笔录记录 id -> 记录"""
+    return dict((str(k), v) for k, v in data['biludata'][2].items())
+
+bilu_data = JsonFileCache("app/demodata/bilu/biludata.json", _bilu_index)
+
+
 @manage.route('/biluAnalyzing/text')
 @login_required
 @super_admin_required   
 def main():
-    with open("app/demodata/bilu/biludata.json", encoding="utf-8")as f:
-        data = json.load(f)
-    print(data)
-    return render_template("admin/biluAnalyzing/web.html",data=data['biludata'][1])
+    return render_template("admin/biluAnalyzing/web.html",data=bilu_data.data['biludata'][1])
 
 @manage.route('/biluAnalyzing/bilutxt',methods=["GET"])
 @login_required
 @super_admin_required
 def bilutxt():
-    print(request.method)
     index = request.args.get("id")
     if index != None :
-        
-        print(index)
-        with open("app/demodata/bilu/biludata.json", encoding="utf-8")as f:
-            data = json.load(f)
-        print(data['biludata'][2][str(index)])
-        return render_template("admin/biluAnalyzing/bilutext.html",data= data['biludata'][2][str(index)])
+        record = bilu_data.get(index)
+        if record is None:
+            abort(404)
+        return render_template("admin/biluAnalyzing/bilutext.html",data=record)
     else:
-        with open("app/demodata/bilu/biludata.json", encoding="utf-8")as f:
-            data = json.load(f)
-        return render_template("admin/biluAnalyzing/bilutext.html",data=data['biludata'][2]['1'])
+        return render_template("admin/biluAnalyzing/bilutext.html",data=bilu_data.get('1'))
         
 @manage.route('/biluAnalyzing/qisutxt')
 @login_required
 @super_admin_required
 def qisutxt():
-    with open("app/demodata/bilu/biludata.json", encoding="utf-8")as f:
-        data = json.load(f)
-    return render_template("admin/biluAnalyzing/qisutext.html",data=data['biludata'][0]['originaltxt'])
+    return render_template("admin/biluAnalyzing/qisutext.html",data=bilu_data.data['biludata'][0]['originaltxt'])
+
+@manage.route('/cache/stats')
+@login_required
+@super_admin_required
+def cache_stats():
+    """缓存命中情况"""
+    return jsonify({'bilu': bilu_data.stats(), 'analysis': get_cache().stats()})
+
+###案件列表###
+def _list_args():
+    """列表接口的公共参数"""
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    brief = request.args.get('brief', '1') != '0'
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else None
+    return dict(after=request.args.get('after'), limit=limit,
+                brief=brief, fields=fields)
+
+@manage.route('/cases')
+@login_required
+@super_admin_required
+def list_cases():
+    """案件列表 ?after=<游标>&limit=50&brief=1&fields=a,b"""
+    return jsonify(law_case_info.list_page(**_list_args()))
+
+@manage.route('/bills')
+@login_required
+@super_admin_required
+def list_bills():
+    """起诉意见书列表 ?after=<游标>&limit=50&brief=1&fields=a,b"""
+    return jsonify(indictment_bill_info.list_page(**_list_args()))
+
+@manage.route('/case')
+@login_required
+@super_admin_required
+def show_case():
+    """案件详情 包括起诉意见书和批注 ?num=案件编号"""
+    aggregate = law_case_info.load_aggregate(request.args.get('num'))
+    if aggregate is None:
+        abort(404)
+    return jsonify(aggregate)
+
+@manage.route('/search')
+@login_required
+@super_admin_required
+def search_view():
+    """全文检索 ?q=关键词&kind=case,bill,comment&page=1&per_page=20"""
+    kinds = request.args.get('kind')
+    per_page = min(request.args.get('per_page', 20, type=int), 100)
+    return jsonify(search.search(request.args.get('q', ''),
+                                 kinds=kinds.split(',') if kinds else None,
+                                 page=max(request.args.get('page', 1, type=int), 1),
+                                 per_page=per_page))
+
+###后台分析任务###
+@manage.route('/analysis/jobs', methods=["POST"])
+@login_required
+@super_admin_required
+def submit_analysis():
+    """提交分析任务 kind=case|bill|bilu&key=案件编号/文书编号/笔录id"""
+    data = request.get_json(silent=True) or request.form
+    kind, key = data.get('kind'), data.get('key')
+    if kind not in ANALYSIS_TARGETS or not key:
+        abort(400)
+    job_id = get_manager().submit(kind, key)
+    if job_id is None:
+        abort(404)
+    return jsonify({'id': job_id,
+                    'status_url': url_for('manage.analysis_status', job_id=job_id)}), 202
+
+@manage.route('/analysis/jobs/<job_id>')
+@login_required
+@super_admin_required
+def analysis_status(job_id):
+    """任务状态和进度"""
+    job = get_manager().status(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+@manage.route('/analysis/result')
+@login_required
+@super_admin_required
+def analysis_result():
+    """已保存的分析结果 ?kind=case|bill|bilu&key=..."""
+    kind = request.args.get('kind')
+    if kind not in ANALYSIS_TARGETS:
+        abort(400)
+    result = get_manager().result(kind, request.args.get('key'))
+    if result is None:
+        abort(404)
+    return jsonify(result)
+
+@manage.route('/analysis/text')
+@login_required
+@super_admin_required
+def analysis_text():
+    """记录当前文本的分析结果 ?kind=case|bill|bilu&key=...
+        分析过相同文本时从缓存返回, 否则提交后台任务, 返回202和任务id
+    """
+    kind, key = request.args.get('kind'), request.args.get('key')
+    if kind not in ANALYSIS_TARGETS:
+        abort(400)
+    manager = get_manager()
+    text = manager.load_text(kind, key)
+    if text is None:
+        abort(404)
+    result = get_cache().get(text_hash(text))
+    if result is not None:
+        return jsonify(result)
+    job_id = manager.submit(kind, key)
+    if job_id is None:
+        abort(404)
+    return jsonify({'id': job_id,
+                    'status_url': url_for('manage.analysis_status', job_id=job_id)}), 202
+
+@manage.route('/analysis/bilu/<int:id>/timeline')
+@login_required
+@super_admin_required
+def bilu_timeline_view(id):
+    """笔录时间线 修改过的笔录只重新分析变化的段落"""
+    return jsonify(bilu_timeline(Bilu.query.get_or_404(id)))
+
+@manage.route('/summary/<field>')
+@login_required
+@super_admin_required
+def case_summary_groups(field):
+    """按 court|year|judge 分组的案件统计 ?court=&year=&limit=100
+        只读汇总表, 汇总表由 flask manage summary-refresh 定时刷新
+    """
+    if field not in summary.GROUP_FIELDS:
+        abort(404)
+    return jsonify(summary.group_by(field, court=request.args.get('court'),
+                                    year=request.args.get('year', type=int),
+                                    limit=min(request.args.get('limit', 100, type=int), 1000)))
+
+@manage.route('/export/<kind>')
+@login_required
+@super_admin_required
+def export_data(kind):
+    """导出 case|bill|comment|bilu ?format=jsonl|csv|parquet&status=1|0|all&since=&until=
+        JSONL/CSV 边读边发送, Parquet 先写入临时文件
+    """
+    fmt = request.args.get('format', 'jsonl')
+    if kind not in export.EXPORT_TARGETS or fmt not in export.FORMATS:
+        abort(404)
+    filters = dict((name, request.args.get(name)) for name in ('status', 'since', 'until'))
+    try:
+        if fmt == 'parquet':
+            tmp = tempfile.TemporaryFile()
+            export.write_parquet(kind, tmp, **filters)
+            tmp.seek(0)
+            response = send_file(tmp, mimetype=export.FORMATS[fmt])
+        else:
+            response = Response(stream_with_context(export.iter_export(kind, fmt, **filters)),
+                                mimetype=export.FORMATS[fmt])
+    except export.ExportError as e:
+        return jsonify({'error': str(e)}), 400
+    response.headers['Content-Disposition'] = 'attachment; filename=%s.%s' % (kind, fmt)
+    return response
+
+@manage.route('/tokens/stats')
+@login_required
+@super_admin_required
+def token_stats():
+    """token验证结果统计"""
+    return jsonify(get_token_service().stats())
+
+@manage.route('/perf')
+@login_required
+@super_admin_required
+def perf_report():
+    """每个路由的耗时分位数和SQL统计, 需要配置 SQL_INSTRUMENTATION"""
+    return jsonify(instrumentation.report())
+
+@manage.route('/pool/stats')
+@login_required
+@super_admin_required
+def pool_stats():
+    """数据库连接池状态"""
+    return jsonify(routing.pool_stats())
 
 #调试用代码
 @manage.route('/hello')
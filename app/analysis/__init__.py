@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""文本分析
+    把 backend.matching 的分析放到后台进程中执行, 结果保存在本地 sqlite 文件中
+"""
+import hashlib
+
+from ..backend.matching import matching
+
+# 分析程序版本, 分析逻辑变化后修改, 旧的结果不再使用
+ANALYZER_VERSION = '1'
+
+
+def run_analysis(text):
+    """对一段文本做匹配/时间线抽取"""
+    return matching(text)
+
+
+def text_hash(text):
+    """输入文本和分析程序版本的hash"""
+    return hashlib.sha1(('%s\n%s' % (ANALYZER_VERSION, text or '')).encode('utf-8')).hexdigest()
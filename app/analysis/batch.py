@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""批量分析
+    按主键把记录分成若干段, 每段交给进程池中的一个进程,
+    进程按块从数据库读取文本, 分析后批量写入结果存储
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .. import db
+from . import store, text_hash
+from .jobs import ANALYSIS_TARGETS
+from .memo import cache_args, open_cache
+
+
+def _create_app():
+    from .. import create_app
+    return create_app(os.getenv('FLASK_CONFIG') or 'default')
+
+
+def shard_bounds(kind, shards):
+    """按主键把记录分成 shards 段, 返回 [(下界, 上界)], 下界不包含, 上界包含, None 表示不限"""
+    model, field = ANALYSIS_TARGETS[kind]
+    key_column = model.__mapper__.primary_key[0]
+    total = db.session.query(db.func.count(key_column)).scalar()
+    if not total:
+        return []
+    shards = max(1, min(shards, total))
+    step = total // shards
+    bounds = []
+    for i in range(1, shards):
+        bounds.append(db.session.query(key_column).order_by(key_column)
+                      .offset(i * step - 1).limit(1).scalar())
+    lowers = [None] + bounds
+    uppers = bounds + [None]
+    return list(zip(lowers, uppers))
+
+
+def _process_shard(kind, lower, upper, path, memo_args, chunk_size, force):
+    """在子进程中处理一段记录, 返回统计信息"""
+    start = time.time()
+    app = _create_app()
+    conn = store.connect(path)
+    memo = open_cache(memo_args)
+    analyzed = skipped = 0
+    model, field = ANALYSIS_TARGETS[kind]
+    with app.app_context():
+        key_column = model.__mapper__.primary_key[0]
+        last = lower
+        while True:
+            query = db.session.query(key_column, getattr(model, field)).order_by(key_column)
+            if last is not None:
+                query = query.filter(key_column > last)
+            if upper is not None:
+                query = query.filter(key_column <= upper)
+            rows = query.limit(chunk_size).all()
+            if not rows:
+                break
+            last = rows[-1][0]
+            hashes = dict((key, text_hash(text)) for key, text in rows)
+            if not force:
+                done = store.existing_hashes(conn, kind, list(hashes))
+                rows = [(key, text) for key, text in rows if done.get(key) != hashes[key]]
+                skipped += len(hashes) - len(rows)
+            results = [(kind, key, hashes[key], memo.analyze(text)) for key, text in rows]
+            store.save_results(conn, results)
+            analyzed += len(results)
+        db.session.remove()
+    conn.close()
+    return {
+        'pid': os.getpid(),
+        'lower': lower,
+        'upper': upper,
+        'analyzed': analyzed,
+        'skipped': skipped,
+        'seconds': time.time() - start,
+    }
+
+
+def run_batch(kind, path, workers=None, chunk_size=200, force=False, report=None):
+    """把全部记录分给 workers 个进程分析
+        force: 为False时跳过已经有当前文本结果的记录
+        report: 每段完成后回调 report(shard_stats)
+        返回总的统计信息
+    """
+    workers = workers or os.cpu_count()
+    start = time.time()
+    shards = shard_bounds(kind, workers)
+    memo_args = cache_args()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_process_shard, kind, lower, upper, path, memo_args,
+                               chunk_size, force)
+                   for lower, upper in shards]
+        for future in as_completed(futures):
+            stats = future.result()
+            results.append(stats)
+            if report is not None:
+                report(stats)
+    seconds = time.time() - start
+    analyzed = sum(s['analyzed'] for s in results)
+    return {
+        'workers': workers,
+        'shards': results,
+        'analyzed': analyzed,
+        'skipped': sum(s['skipped'] for s in results),
+        'seconds': seconds,
+        'rows_per_sec': analyzed / seconds if seconds else 0.0,
+    }
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""笔录的增量时间线抽取
+    笔录按段落切分, 分析结果按段落文本的hash缓存, 不另外保存分段.
+    修改笔录后只有缓存中没有的段落需要分析, 其余段落的结果从缓存取出后合并成整篇的时间线.
+    段落缓存和其它笔录、整篇文本的结果共用, 删掉的段落不主动清除, 由LRU淘汰.
+"""
+from . import text_hash, run_analysis
+from .memo import get_cache
+
+
+def split_chunks(body):
+    """按行切分段落, 去掉空行"""
+    return [line.strip() for line in (body or '').splitlines() if line.strip()]
+
+
+def merge_timelines(results):
+    """按段落顺序合并各段的时间线, 每个事件记录来自哪一段"""
+    timeline = []
+    for position, result in enumerate(results):
+        events = result.get('timeline', []) if isinstance(result, dict) else result
+        for event in events or []:
+            if isinstance(event, dict):
+                event = dict(event, chunk=position)
+            timeline.append(event)
+    return timeline
+
+
+def bilu_timeline(bilu):
+    """返回笔录的时间线, 只分析缓存中没有的段落
+        返回 {'timeline': [...], 'chunks': 段落数, 'analyzed': 本次重新分析的段落数}
+    """
+    cache = get_cache()
+    chunks = split_chunks(bilu.body)
+    results = []
+    analyzed = 0
+    for chunk in chunks:
+        key = text_hash(chunk)
+        result = cache.get(key)
+        if result is None:
+            result = run_analysis(chunk)
+            cache.put(key, result)
+            analyzed += 1
+        results.append(result)
+    return {
+        'timeline': merge_timelines(results),
+        'chunks': len(chunks),
+        'analyzed': analyzed,
+    }
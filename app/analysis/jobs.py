@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""后台分析任务
+    任务和结果保存在本地 sqlite 文件 (ANALYSIS_DB_PATH) 中, 不依赖外部消息队列,
+    由进程池 (ANALYSIS_WORKERS 个进程) 执行.
+    每个任务先原子地领取 (记录执行的进程 host:pid) 再执行, 多个web进程不会重复执行;
+    创建进程池时以及之后每隔 RECOVER_INTERVAL 秒, 接管排队中的任务, 以及执行进程已经退出
+    或超过 ANALYSIS_JOB_LEASE 秒没有更新的任务.
+    进程池中的进程异常退出时任务标记为失败, 进程池重新创建.
+"""
+import os
+import time
+import socket
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app
+
+from ..models import Bilu, law_case_info, indictment_bill_info
+from . import store, text_hash
+from .memo import cache_args, open_cache
+
+# 执行中的任务超过这个秒数没有更新, 视为执行进程已经退出
+DEFAULT_LEASE = 3600
+
+# 提交任务时检查是否有需要接管的任务的间隔 (秒)
+RECOVER_INTERVAL = 60
+
+# 分析类型 -> (模型, 分析的字段)
+ANALYSIS_TARGETS = {
+    'case': (law_case_info, 'low_case_content'),
+    'bill': (indictment_bill_info, 'bill_fact_and_reason'),
+    'bilu': (Bilu, 'body'),
+}
+
+
+def _run_job(path, memo_args, job_id, kind, key, text, input_hash):
+    """在后台进程中执行一个任务, 相同文本的结果从缓存中取"""
+    conn = store.connect(path)
+    try:
+        store.update_job(conn, job_id, store.RUNNING, 10)
+        result = open_cache(memo_args).analyze(text)
+        store.update_job(conn, job_id, store.RUNNING, 90)
+        store.save_results(conn, [(kind, key, input_hash, result)])
+        store.update_job(conn, job_id, store.DONE, 100)
+    except Exception:
+        store.update_job(conn, job_id, store.FAILED, 100, traceback.format_exc())
+    finally:
+        conn.close()
+
+
+class JobManager(object):
+    """提交任务, 查询任务状态和结果"""
+
+    def __init__(self, path, workers=None, memo_args=None, lease=DEFAULT_LEASE):
+        self.path = path
+        self.memo_args = memo_args
+        self.workers = workers or os.cpu_count()
+        self.lease = lease
+        self._pool = None
+        self._recovered = 0
+        # 恢复任务时可能重建进程池, 需要可重入
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = store.connect(self.path)
+        return conn
+
+    @property
+    def owner(self):
+        # 每次取当前pid, fork 出的进程不会沿用父进程的标识
+        return '%s:%d' % (socket.gethostname(), os.getpid())
+
+    @staticmethod
+    def _owner_alive(owner):
+        """同一台机器上的进程检查是否存在, 其它机器上的返回None, 由租期判断"""
+        host, _, pid = (owner or '').rpartition(':')
+        if host != socket.gethostname() or not pid.isdigit():
+            return None
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _recover(self, pool):
+        """接管没有进程在执行的任务
+            执行进程还在但超过租期没有更新的也接管, 进程可能卡住或者进程池中的进程已经退出
+        """
+        conn = self._conn()
+        owner = self.owner
+        now = time.time()
+        self._recovered = now
+        for job in store.pending_jobs(conn):
+            job_id, kind, key, text, input_hash, status, old_owner, updated = job
+            if status == store.QUEUED:
+                claimed = store.claim_job(conn, job_id, owner)
+            else:
+                stale = (self._owner_alive(old_owner) is False or
+                         now - updated >= self.lease)
+                claimed = stale and store.reclaim_job(conn, job_id, old_owner, updated, owner)
+            if claimed:
+                self._submit(pool, job_id, kind, key, text, input_hash)
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    pool = ProcessPoolExecutor(max_workers=self.workers)
+                    self._recover(pool)
+                    self._pool = pool
+        elif time.time() - self._recovered >= RECOVER_INTERVAL:
+            with self._lock:
+                if time.time() - self._recovered >= RECOVER_INTERVAL:
+                    self._recover(self._pool)
+        return self._pool
+
+    def _reset_pool(self, pool):
+        """进程池损坏后丢弃, 下次使用时重新创建"""
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def _on_done(self, job_id, future):
+        """任务没有正常返回 (进程池中的进程异常退出) 时标记为失败"""
+        if future.cancelled():
+            error = 'cancelled'
+        elif future.exception() is not None:
+            error = repr(future.exception())
+        else:
+            return
+        store.update_job(self._conn(), job_id, store.FAILED, 100, error)
+
+    def _submit(self, pool, job_id, kind, key, text, input_hash):
+        """提交到进程池, 进程池已经损坏时标记任务失败并重建进程池"""
+        try:
+            future = pool.submit(_run_job, self.path, self.memo_args,
+                                 job_id, kind, key, text, input_hash)
+        except BrokenProcessPool as e:
+            store.update_job(self._conn(), job_id, store.FAILED, 100, repr(e))
+            self._reset_pool(pool)
+            return False
+        future.add_done_callback(lambda f: self._on_done(job_id, f))
+        return True
+
+    @staticmethod
+    def load_text(kind, key):
+        """读取记录中需要分析的文本, 记录不存在时返回None"""
+        model, field = ANALYSIS_TARGETS[kind]
+        obj = model.query.get(key)
+        return getattr(obj, field) if obj is not None else None
+
+    def submit(self, kind, key):
+        """提交一个任务, 返回任务id; 已经有当前文本的结果时直接标记为完成"""
+        text = self.load_text(kind, key)
+        if text is None:
+            return None
+        input_hash = text_hash(text)
+        conn = self._conn()
+        job_id = store.create_job(conn, kind, key, text, input_hash)
+        if store.get_result(conn, kind, key, input_hash) is not None:
+            store.update_job(conn, job_id, store.DONE, 100)
+            return job_id
+        pool = self._get_pool()
+        # 其它进程恢复任务时可能已经领取
+        if store.claim_job(conn, job_id, self.owner):
+            if not self._submit(pool, job_id, kind, key, text, input_hash):
+                # 进程池损坏, 用新的进程池再提交一次
+                store.update_job(conn, job_id, store.RUNNING, 0)
+                self._submit(self._get_pool(), job_id, kind, key, text, input_hash)
+        return job_id
+
+    def status(self, job_id):
+        return store.get_job(self._conn(), job_id)
+
+    def result(self, kind, key):
+        """返回记录当前文本的分析结果, 没有时返回None"""
+        text = self.load_text(kind, key)
+        if text is None:
+            return None
+        return store.get_result(self._conn(), kind, key, text_hash(text))
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager():
+    """返回当前应用的任务管理器"""
+    global _manager
+    path = current_app.config.get('ANALYSIS_DB_PATH', 'analysis.sqlite')
+    if _manager is None or _manager.path != path:
+        with _manager_lock:
+            if _manager is None or _manager.path != path:
+                _manager = JobManager(path, current_app.config.get('ANALYSIS_WORKERS'),
+                                      cache_args(),
+                                      current_app.config.get('ANALYSIS_JOB_LEASE', DEFAULT_LEASE))
+    return _manager
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""按文本内容缓存分析结果
+    键为输入文本和分析程序版本的hash (text_hash), 相同文本只分析一次.
+    结果保存在本地 sqlite 文件 (ANALYSIS_CACHE_PATH) 中, 总大小超过
+    ANALYSIS_CACHE_MAX_BYTES 时按最近访问时间淘汰; 进程内另有一个小的LRU缓存.
+    记录文本被修改后不删除旧文本的结果, 其它记录可能有相同的文本, 不再使用的结果由LRU淘汰.
+"""
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+from . import run_analysis, text_hash
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS memo (
+    hash TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_memo_last_access ON memo (last_access);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta VALUES ('bytes', 0);
+'''
+
+# 磁盘上的访问时间超过这个秒数才更新, 避免每次命中都写文件
+TOUCH_INTERVAL = 60
+
+
+class ResultCache(object):
+    """两级缓存: 进程内LRU + 本地sqlite文件"""
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, front_size=256):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.front_size = front_size
+        self._front = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._front[key] = value
+            self._front.move_to_end(key)
+            while len(self._front) > self.front_size:
+                self._front.popitem(last=False)
+
+    def get(self, key):
+        """返回缓存的结果, 没有时返回None"""
+        with self._lock:
+            if key in self._front:
+                self._front.move_to_end(key)
+                self.hits += 1
+                return self._front[key]
+        conn = self._conn()
+        row = conn.execute('SELECT result, last_access FROM memo WHERE hash=?', (key,)).fetchone()
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        now = time.time()
+        if now - row[1] > TOUCH_INTERVAL:
+            with conn:
+                conn.execute('UPDATE memo SET last_access=? WHERE hash=?', (now, key))
+        value = json.loads(row[0])
+        self._remember(key, value)
+        with self._lock:
+            self.disk_hits += 1
+        return value
+
+    def put(self, key, value):
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(data.encode('utf-8'))
+        conn = self._conn()
+        with conn:
+            old = conn.execute('SELECT size FROM memo WHERE hash=?', (key,)).fetchone()
+            conn.execute('INSERT OR REPLACE INTO memo (hash, result, size, last_access) '
+                         'VALUES (?, ?, ?, ?)', (key, data, size, time.time()))
+            conn.execute("UPDATE meta SET value=value+? WHERE name='bytes'",
+                         (size - (old[0] if old else 0),))
+            self._evict(conn)
+        self._remember(key, value)
+
+    def _evict(self, conn):
+        """超过大小上限时删除最久没有访问的结果"""
+        total = conn.execute("SELECT value FROM meta WHERE name='bytes'").fetchone()[0]
+        while total > self.max_bytes:
+            rows = conn.execute('SELECT hash, size FROM memo ORDER BY last_access LIMIT 100').fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                conn.execute('DELETE FROM memo WHERE hash=?', (key,))
+                total -= size
+                with self._lock:
+                    self._front.pop(key, None)
+                if total <= self.max_bytes:
+                    break
+            conn.execute("UPDATE meta SET value=? WHERE name='bytes'", (total,))
+
+    def discard(self, keys):
+        """删除一组缓存"""
+        conn = self._conn()
+        with conn:
+            for key in keys:
+                row = conn.execute('SELECT size FROM memo WHERE hash=?', (key,)).fetchone()
+                if row is not None:
+                    conn.execute('DELETE FROM memo WHERE hash=?', (key,))
+                    conn.execute("UPDATE meta SET value=value-? WHERE name='bytes'", row)
+                with self._lock:
+                    self._front.pop(key, None)
+
+    def analyze(self, text):
+        """返回文本的分析结果, 已经分析过的直接从缓存取"""
+        key = text_hash(text)
+        result = self.get(key)
+        if result is None:
+            result = run_analysis(text)
+            self.put(key, result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {'path': self.path, 'hits': self.hits, 'disk_hits': self.disk_hits,
+                    'misses': self.misses, 'front_size': len(self._front)}
+
+
+_caches = {}
+_cache_lock = threading.Lock()
+
+
+def cache_args():
+    """当前应用的缓存参数, 可以传给后台进程"""
+    config = current_app.config
+    return (config.get('ANALYSIS_CACHE_PATH', 'analysis_cache.sqlite'),
+            config.get('ANALYSIS_CACHE_MAX_BYTES', 256 * 1024 * 1024),
+            config.get('ANALYSIS_CACHE_FRONT_SIZE', 256))
+
+
+def open_cache(args):
+    """按参数返回本进程中的缓存对象"""
+    cache = _caches.get(args)
+    if cache is None:
+        with _cache_lock:
+            cache = _caches.get(args)
+            if cache is None:
+                cache = _caches[args] = ResultCache(*args)
+    return cache
+
+
+def get_cache():
+    """返回当前应用的结果缓存"""
+    return open_cache(cache_args())
+
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""任务队列和分析结果的本地存储"""
+import json
+import time
+import uuid
+import sqlite3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    input TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    -- 执行任务的进程 host:pid
+    owner TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_status ON jobs (status, created);
+CREATE TABLE IF NOT EXISTS results (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    result TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+'''
+
+# 任务状态
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def connect(path):
+    """打开存储文件, web进程和后台进程各自打开"""
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(jobs)')]
+    if 'owner' not in columns:
+        with conn:
+            conn.execute('ALTER TABLE jobs ADD COLUMN owner TEXT')
+    return conn
+
+
+def create_job(conn, kind, key, text, input_hash):
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with conn:
+        conn.execute('INSERT INTO jobs (id, kind, key, input, input_hash, status, created, updated) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     (job_id, kind, key, text, input_hash, QUEUED, now, now))
+    return job_id
+
+
+def update_job(conn, job_id, status, progress, error=None):
+    with conn:
+        conn.execute('UPDATE jobs SET status=?, progress=?, error=?, updated=? WHERE id=?',
+                     (status, progress, error, time.time(), job_id))
+
+
+def get_job(conn, job_id):
+    row = conn.execute('SELECT id, kind, key, input_hash, status, progress, error, created, updated '
+                       'FROM jobs WHERE id=?', (job_id,)).fetchone()
+    if row is None:
+        return None
+    return dict(zip(('id', 'kind', 'key', 'input_hash', 'status', 'progress',
+                     'error', 'created', 'updated'), row))
+
+
+def claim_job(conn, job_id, owner):
+    """把排队的任务标记为由 owner 执行, 其它进程已经领取时返回False"""
+    with conn:
+        cur = conn.execute('UPDATE jobs SET status=?, owner=?, updated=? WHERE id=? AND status=?',
+                           (RUNNING, owner, time.time(), job_id, QUEUED))
+    return cur.rowcount == 1
+
+
+def reclaim_job(conn, job_id, old_owner, updated, owner):
+    """接管执行中的任务, 只有状态、原owner和更新时间都没有变化时才成功"""
+    with conn:
+        cur = conn.execute('UPDATE jobs SET owner=?, updated=? WHERE id=? AND status=? '
+                           'AND owner IS ? AND updated=?',
+                           (owner, time.time(), job_id, RUNNING, old_owner, updated))
+    return cur.rowcount == 1
+
+
+def pending_jobs(conn):
+    """未完成的任务 [(id, kind, key, input, input_hash, status, owner, updated)]"""
+    return conn.execute('SELECT id, kind, key, input, input_hash, status, owner, updated FROM jobs '
+                        'WHERE status IN (?, ?) ORDER BY created',
+                        (QUEUED, RUNNING)).fetchall()
+
+
+def save_results(conn, rows):
+    """批量保存结果 rows: [(kind, key, input_hash, result)]"""
+    now = time.time()
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO results (kind, key, input_hash, result, created) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         [(kind, key, input_hash, json.dumps(result, ensure_ascii=False), now)
+                          for kind, key, input_hash, result in rows])
+
+
+def get_result(conn, kind, key, input_hash):
+    """返回与当前文本对应的结果, 文本变化后的旧结果不返回"""
+    row = conn.execute('SELECT result FROM results WHERE kind=? AND key=? AND input_hash=?',
+                       (kind, key, input_hash)).fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+
+def existing_hashes(conn, kind, keys):
+    """返回已有结果的 {key: input_hash}"""
+    if not keys:
+        return {}
+    return dict(conn.execute(
+        'SELECT key, input_hash FROM results WHERE kind=? AND key IN (%s)' % ','.join('?' * len(keys)),
+        [kind] + list(keys)).fetchall())
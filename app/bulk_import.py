@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""案件/起诉意见书批量导入
+    从 JSONL 或 CSV 文件流式读取, 经 update_from_json 做字段映射,
+    按批写入, 每批只提交一次, 按主键做 upsert, 支持断点续传
+"""
+import os
+import csv
+import json
+import time
+from itertools import islice
+from datetime import datetime
+
+from . import db
+from .models import law_case_info, indictment_bill_info
+
+# 导入类型 -> (模型, 主键字段)
+IMPORT_TARGETS = {
+    'case': (law_case_info, 'low_case_num'),
+    'bill': (indictment_bill_info, 'bill_num'),
+}
+
+DATETIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+                    '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%d')
+
+
+def read_rows(path):
+    """按扩展名逐行读取 jsonl 或 csv, 每行返回一个dict"""
+    with open(path, encoding='utf-8', newline='') as f:
+        if path.endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield dict((k, v if v != '' else None) for k, v in row.items())
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def parse_datetime(value):
+    """把文本日期转换成datetime, 其它值原样返回"""
+    if not isinstance(value, str):
+        return value
+    for fmt in DATETIME_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError('无法解析的日期: %s' % value)
+
+
+def _datetime_fields(model):
+    return [c.name for c in model.__table__.columns
+            if isinstance(c.type, db.DateTime)]
+
+
+def read_checkpoint(checkpoint):
+    """返回已经提交的行数"""
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return 0
+    with open(checkpoint, encoding='utf-8') as f:
+        return json.load(f).get('rows', 0)
+
+
+def write_checkpoint(checkpoint, path, rows):
+    tmp = checkpoint + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'path': path, 'rows': rows}, f)
+    os.replace(tmp, checkpoint)
+
+
+def bulk_import(path, kind, batch_size=1000, checkpoint=None, report=None):
+    """批量导入
+        kind: 'case' 或 'bill'
+        checkpoint: 断点文件路径, 每批提交后记录已完成的行数, 重新运行时跳过这些行
+        report: 每批完成后回调 report(stats)
+        返回统计信息 {'rows', 'inserted', 'updated', 'seconds', 'rows_per_sec'}
+    """
+    model, key = IMPORT_TARGETS[kind]
+    key_column = getattr(model, key)
+    datetime_fields = _datetime_fields(model)
+    done = read_checkpoint(checkpoint)
+    rows = islice(read_rows(path), done, None)
+    stats = {'rows': done, 'inserted': 0, 'updated': 0,
+             'seconds': 0.0, 'rows_per_sec': 0.0}
+    processed = 0
+    start = time.time()
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        keys = [data.get(key) for data in batch]
+        existing = dict((getattr(obj, key), obj) for obj in
+                        model.query.with_inactive().filter(key_column.in_(keys)))
+        for data in batch:
+            for field in datetime_fields:
+                if field in data:
+                    data[field] = parse_datetime(data[field])
+            obj = existing.get(data.get(key))
+            if obj is None:
+                obj = model()
+                setattr(obj, key, data.get(key))
+                db.session.add(obj)
+                existing[data.get(key)] = obj
+                stats['inserted'] += 1
+            else:
+                stats['updated'] += 1
+            obj.update_from_json(data)
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        # 提交后清空会话, 内存占用不随导入量增长
+        db.session.expunge_all()
+        processed += len(batch)
+        stats['rows'] = done + processed
+        if checkpoint is not None:
+            write_checkpoint(checkpoint, path, stats['rows'])
+        stats['seconds'] = time.time() - start
+        stats['rows_per_sec'] = processed / stats['seconds'] if stats['seconds'] else 0.0
+        if report is not None:
+            report(stats)
+    return stats
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import threading
+
+
+class JsonFileCache(object):
+    """json文件解析缓存
+        每个进程只解析一次, 文件的 mtime 或大小变化后才重新加载
+        返回的数据在多个请求之间共享, 调用方不要修改
+    """
+
+    def __init__(self, path, build_index=None, encoding='utf-8'):
+        self.path = path
+        self.encoding = encoding
+        # 根据解析结果建立 id -> 记录 的索引
+        self.build_index = build_index
+        self._lock = threading.Lock()
+        self._signature = None
+        self._data = None
+        self._index = None
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def _stat(self):
+        st = os.stat(self.path)
+        return st.st_mtime_ns, st.st_size
+
+    def _load(self):
+        signature = self._stat()
+        with self._lock:
+            if signature == self._signature:
+                self.hits += 1
+                return self._data, self._index
+            with open(self.path, encoding=self.encoding) as f:
+                data = json.load(f)
+            index = self.build_index(data) if self.build_index else {}
+            if self._signature is None:
+                self.misses += 1
+            else:
+                self.reloads += 1
+            self._data, self._index, self._signature = data, index, signature
+            return data, index
+
+    @property
+    def data(self):
+        """返回整个解析结果"""
+        return self._load()[0]
+
+    def get(self, key, default=None):
+        """按 id 从索引中取出一条记录"""
+        return self._load()[1].get(str(key), default)
+
+    def stats(self):
+        """返回命中/未命中/重新加载次数"""
+        with self._lock:
+            return {
+                'path': self.path,
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+                'records': len(self._index or {}),
+            }
+
+
+class TTLCache(object):
+    """带过期时间的进程内缓存, 线程安全"""
+
+    def __init__(self, ttl=60, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._items = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] > now:
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                del self._items[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if key not in self._items and len(self._items) >= self.maxsize:
+                # 满了先丢掉最早放入的一项
+                self._items.pop(next(iter(self._items)))
+            self._items[key] = (expires, value)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+        return item[1] if item is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._items)}
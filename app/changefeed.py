@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""案件相关表的变更记录
+    通过 session 事件在同一事务中把新增/修改/删除写入 change_log,
+    消费者保存自己处理到的 seq, 按批读取之后的记录, 实现增量刷新.
+    Query.update()/delete() 之类的批量语句不经过 session 事件, 不会记录.
+    seq 在flush时分配, 事务提交的顺序可能和seq不同: 先分配到 10 的事务可能在 11 之后提交.
+    所以 tail() 读到中间有空缺的seq时先停下, 等空缺补上再继续; 空缺超过
+    CHANGEFEED_GAP_SECONDS 秒 (默认60) 还没有补上, 视为事务已经回滚, 跳过.
+    比这更长的事务中的变更仍可能漏掉, 需要时用消费者自己的全量重建补齐.
+"""
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from . import db
+from .models import (ChangeLog, ChangeOffset, law_case_info, indictment_bill_info,
+                     comment_info)
+
+# 记录变更的模型 -> 主键字段, 这些模型都有所属案件编号 low_case_num
+TRACKED = {
+    law_case_info: 'low_case_num',
+    indictment_bill_info: 'bill_num',
+    comment_info: 'comment_num',
+}
+
+INSERT = 'I'
+UPDATE = 'U'
+DELETE = 'D'
+
+
+def _after_flush(session, flush_context):
+    rows = []
+    now = datetime.utcnow()
+    for objs, op in ((session.new, INSERT), (session.dirty, UPDATE), (session.deleted, DELETE)):
+        for obj in objs:
+            key = TRACKED.get(type(obj))
+            if key is None:
+                continue
+            old_case_num = None
+            if op == UPDATE:
+                if not session.is_modified(obj, include_collections=False):
+                    continue
+                # after_flush 中属性的修改历史还在
+                deleted = db.inspect(obj).attrs.low_case_num.history.deleted
+                if deleted and deleted[0] != obj.low_case_num:
+                    old_case_num = deleted[0]
+            rows.append({'table_name': obj.__table__.name, 'row_key': getattr(obj, key),
+                         'case_num': obj.low_case_num, 'old_case_num': old_case_num,
+                         'op': op, 'timestamp': now})
+    if rows:
+        session.connection().execute(ChangeLog.__table__.insert(), rows)
+
+
+db.event.listen(db.session, 'after_flush', _after_flush)
+
+
+def last_seq():
+    """当前最新的seq"""
+    return db.session.query(db.func.max(ChangeLog.seq)).scalar() or 0
+
+
+def get_offset(consumer):
+    offset = ChangeOffset.query.get(consumer)
+    return offset.seq if offset is not None else 0
+
+
+def _contiguous(offset, entries):
+    """去掉第一个可能还没提交的空缺之后的变更"""
+    if not entries:
+        return entries
+    gap = timedelta(seconds=current_app.config.get('CHANGEFEED_GAP_SECONDS', 60))
+    settled = datetime.utcnow() - gap
+    expected = offset + 1
+    for i, entry in enumerate(entries):
+        # 按表过滤时, 跳过的seq可能属于其它表, 查询确认是否真的缺少
+        if entry.seq != expected and entry.timestamp > settled and _missing(expected, entry.seq):
+            return entries[:i]
+        expected = entry.seq + 1
+    return entries
+
+
+def _missing(low, high):
+    """[low, high) 之间是否有seq还不可见"""
+    count = ChangeLog.query.filter(ChangeLog.seq >= low, ChangeLog.seq < high).count()
+    return count < high - low
+
+
+def tail(consumer, batch_size=500, tables=None, collapse=True):
+    """读取消费者上次位置之后的一批变更
+        collapse: 同一行的多次变更只保留最后一次
+        返回 (变更列表, 这一批最后的seq); 没有新变更时最后的seq为当前位置
+    """
+    offset = get_offset(consumer)
+    query = ChangeLog.query.filter(ChangeLog.seq > offset)
+    if tables:
+        query = query.filter(ChangeLog.table_name.in_(tables))
+    entries = _contiguous(offset, query.order_by(ChangeLog.seq).limit(batch_size).all())
+    if not entries:
+        return [], offset
+    last_seq = entries[-1].seq
+    if collapse:
+        latest = {}
+        for entry in entries:
+            latest[(entry.table_name, entry.row_key)] = entry
+        entries = sorted(latest.values(), key=lambda e: e.seq)
+    return entries, last_seq
+
+
+def commit_offset(consumer, seq):
+    """保存消费位置, 和消费者自己的修改一起提交"""
+    offset = ChangeOffset.query.get(consumer)
+    if offset is None:
+        offset = ChangeOffset(consumer=consumer, seq=seq)
+    else:
+        offset.seq = max(offset.seq, seq)
+    db.session.add(offset)
+
+
+def consume(consumer, handler, batch_size=500, tables=None, collapse=True):
+    """处理所有新的变更, handler(entries) 处理一批, 每批提交一次, 返回处理的变更数"""
+    count = 0
+    while True:
+        entries, last_seq = tail(consumer, batch_size, tables, collapse)
+        if not entries:
+            break
+        handler(entries)
+        commit_offset(consumer, last_seq)
+        db.session.commit()
+        count += len(entries)
+    return count
+
+
+def compact(retain_days=None):
+    """删除所有消费者都处理过的变更; retain_days 指定时, 更早的变更无论是否处理都删除
+        返回删除的条数
+    """
+    low = db.session.query(db.func.min(ChangeOffset.seq)).scalar() or 0
+    condition = ChangeLog.seq <= low
+    if retain_days is not None:
+        condition = db.or_(condition, ChangeLog.timestamp <
+                           datetime.utcnow() - timedelta(days=retain_days))
+    # 始终保留最后一条, 数据库重启后自增值不会从已删除的seq重新开始
+    condition = db.and_(condition, ChangeLog.seq < last_seq())
+    count = ChangeLog.query.filter(condition).delete(synchronize_session=False)
+    db.session.commit()
+    return count
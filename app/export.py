@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""数据导出
+    用服务端游标按块读取, 逐行写出 JSONL/CSV, 内存占用与导出行数无关.
+    Parquet 需要安装 pyarrow, 每块写成一个 row group.
+    字段和转换沿用 serializers 中的 Schema.
+"""
+import io
+import csv
+import json
+from itertools import islice
+from datetime import date, datetime
+
+from . import db
+from .models import Bilu, law_case_info, RECORD_ACTIVE
+from .routing import read_query
+from .bulk_import import parse_datetime
+from .serializers import Schema, DateField, bill_schema, comment_schema
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# 每次从数据库读取的行数
+CHUNK_SIZE = 1000
+
+# CSV 缓冲超过这个大小时发送一次
+CSV_FLUSH_SIZE = 64 * 1024
+
+FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+# 导出时不生成url, 命令行中没有请求上下文
+bilu_export_schema = Schema(Bilu, [
+    ('id', 'id'),
+    ('title', 'title'),
+    ('body', 'body'),
+    ('act_date', DateField()),
+    ('timestamp', 'timestamp'),
+])
+
+# to_json 不输出案件事实, 导出时需要
+case_export_schema = Schema(law_case_info, [(name, name) for name in (
+    'low_case_num', 'low_case_reason', 'low_case_party', 'low_case_content',
+    'low_case_court', 'low_case_decision_time', 'low_case_executive_judge',
+    'low_case_defence_counsel', 'low_case_name', 'record_status', 'create_datetime',
+    'create_by', 'update_datetime', 'update_by')])
+
+# 导出类型 -> (Schema, 按日期过滤的字段)
+EXPORT_TARGETS = {
+    'case': (case_export_schema, 'update_datetime'),
+    'bill': (bill_schema, 'update_datetime'),
+    'comment': (comment_schema, 'update_datetime'),
+    'bilu': (bilu_export_schema, 'timestamp'),
+}
+
+# 导出全部状态的记录
+ALL_STATUS = 'all'
+
+
+class ExportError(ValueError):
+    """导出参数错误"""
+
+
+def build_query(kind, status=None, since=None, until=None):
+    """按条件生成导出查询, 按主键排序
+        status: 记录状态, 默认只导出有效记录, 'all' 导出全部; 笔录没有记录状态
+        since/until: 日期字段的范围 [since, until), 可以是文本
+    """
+    if kind not in EXPORT_TARGETS:
+        raise ExportError('不支持的导出类型: %s' % kind)
+    schema, date_field = EXPORT_TARGETS[kind]
+    model = schema.model
+    query = read_query(model)
+    if hasattr(model, 'record_status'):
+        if status == ALL_STATUS:
+            query = query.with_inactive()
+        elif status is not None and status != RECORD_ACTIVE:
+            query = query.with_inactive().filter(model.record_status == status)
+    elif status not in (None, ALL_STATUS):
+        raise ExportError('%s 没有记录状态' % kind)
+    date_column = getattr(model, date_field)
+    try:
+        if since:
+            query = query.filter(date_column >= parse_datetime(since))
+        if until:
+            query = query.filter(date_column < parse_datetime(until))
+    except ValueError as e:
+        raise ExportError(str(e))
+    return query.order_by(*model.__mapper__.primary_key)
+
+
+def iter_rows(kind, chunk_size=CHUNK_SIZE, **filters):
+    """按块读取, 逐行返回序列化后的dict"""
+    schema = EXPORT_TARGETS[kind][0]
+    return schema.iter_query(build_query(kind, **filters), chunk_size=chunk_size)
+
+
+def field_names(kind):
+    return [name for name, field in EXPORT_TARGETS[kind][0].fields]
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError('%r 不能转换为json' % value)
+
+
+def iter_jsonl(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False, default=_json_default) + '\n'
+
+
+def iter_csv(rows, names):
+    """先输出表头, 缓冲到 CSV_FLUSH_SIZE 再输出"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(names)
+    for row in rows:
+        writer.writerow([_csv_value(row[name]) for name in names])
+        if buf.tell() >= CSV_FLUSH_SIZE:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate(0)
+    yield buf.getvalue()
+
+
+def _csv_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _arrow_type(model, field):
+    if isinstance(field, DateField):
+        return pyarrow.string()
+    column = model.__table__.columns.get(field.source)
+    column_type = column.type if column is not None else None
+    if isinstance(column_type, db.Boolean):
+        return pyarrow.bool_()
+    if isinstance(column_type, db.Integer):
+        return pyarrow.int64()
+    if isinstance(column_type, db.DateTime):
+        return pyarrow.timestamp('us')
+    if isinstance(column_type, db.Date):
+        return pyarrow.date32()
+    return pyarrow.string()
+
+
+def arrow_schema(kind):
+    schema = EXPORT_TARGETS[kind][0]
+    return pyarrow.schema([(name, _arrow_type(schema.model, field))
+                           for name, field in schema.fields])
+
+
+def write_parquet(kind, where, chunk_size=CHUNK_SIZE, **filters):
+    """写入 Parquet 文件, where 是路径或可写的文件对象, 返回行数"""
+    if pyarrow is None:
+        raise ExportError('导出 Parquet 需要安装 pyarrow')
+    schema = arrow_schema(kind)
+    names = schema.names
+    rows = iter_rows(kind, chunk_size=chunk_size, **filters)
+    count = 0
+    with pyarrow.parquet.ParquetWriter(where, schema) as writer:
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            columns = dict((name, [row[name] for row in chunk]) for name in names)
+            writer.write_table(pyarrow.Table.from_pydict(columns, schema=schema))
+            count += len(chunk)
+    return count
+
+
+def iter_export(kind, fmt, chunk_size=CHUNK_SIZE, **filters):
+    """JSONL/CSV 的文本块"""
+    rows = iter_rows(kind, chunk_size=chunk_size, **filters)
+    if fmt == 'jsonl':
+        return iter_jsonl(rows)
+    if fmt == 'csv':
+        return iter_csv(rows, field_names(kind))
+    raise ExportError('不支持流式输出的格式: %s' % fmt)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""请求级别的SQL和模板耗时统计
+    SQL_INSTRUMENTATION 为真时启用, 否则不注册任何事件, 没有额外开销.
+    每个请求记录SQL条数、数据库总耗时、最慢的几条SQL和模板渲染耗时,
+    超过 SLOW_REQUEST_MS 的请求写入日志, 每个路由保留最近 PERF_SAMPLES 个请求用于计算分位数.
+"""
+import time
+import heapq
+import threading
+from collections import deque
+
+from flask import g, request, has_request_context
+from flask import request_started, request_finished, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# 每个请求保留的最慢SQL条数
+SLOWEST = 5
+
+# 路由 -> 最近的请求 (总耗时, SQL条数, 数据库耗时, 模板耗时)
+_samples = {}
+_samples_lock = threading.Lock()
+_engine_hooked = False
+
+
+def _perf():
+    if has_request_context():
+        return g.get('_perf')
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _perf() is not None:
+        conn.info.setdefault('_perf_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    perf = _perf()
+    starts = conn.info.get('_perf_start')
+    if perf is None or not starts:
+        return
+    duration = time.perf_counter() - starts.pop()
+    perf['statements'] += 1
+    perf['db_time'] += duration
+    item = (duration, perf['statements'], statement, repr(parameters)[:200])
+    if len(perf['slowest']) < SLOWEST:
+        heapq.heappush(perf['slowest'], item)
+    else:
+        heapq.heappushpop(perf['slowest'], item)
+
+
+def _request_started(sender, **extra):
+    g._perf = {'start': time.perf_counter(), 'statements': 0, 'db_time': 0.0,
+               'slowest': [], 'template_time': 0.0, 'templates': []}
+
+
+def _before_render_template(sender, template, context, **extra):
+    perf = _perf()
+    if perf is not None:
+        perf['templates'].append(time.perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    perf = _perf()
+    if perf is not None and perf['templates']:
+        perf['template_time'] += time.perf_counter() - perf['templates'].pop()
+
+
+def _request_finished(sender, response, **extra):
+    perf = _perf()
+    if perf is None:
+        return
+    total = time.perf_counter() - perf['start']
+    route = request.url_rule.rule if request.url_rule is not None else request.endpoint or '-'
+    sample = (total, perf['statements'], perf['db_time'], perf['template_time'])
+    with _samples_lock:
+        samples = _samples.get(route)
+        if samples is None:
+            samples = _samples[route] = deque(maxlen=sender.config.get('PERF_SAMPLES', 1000))
+        samples.append(sample)
+    if total * 1000 >= sender.config.get('SLOW_REQUEST_MS', 500):
+        slowest = sorted(perf['slowest'], reverse=True)
+        sender.logger.warning(
+            '慢请求 %s %s: %.1fms, SQL %d 条 %.1fms, 模板 %.1fms\n%s',
+            request.method, request.path, total * 1000, perf['statements'],
+            perf['db_time'] * 1000, perf['template_time'] * 1000,
+            '\n'.join('  %.1fms %s %s' % (d * 1000, s, p) for d, n, s, p in slowest))
+
+
+def init_app(app):
+    """按配置注册统计用的事件"""
+    global _engine_hooked
+    if not app.config.get('SQL_INSTRUMENTATION'):
+        return
+    if not _engine_hooked:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _engine_hooked = True
+    request_started.connect(_request_started, app)
+    request_finished.connect(_request_finished, app)
+    before_render_template.connect(_before_render_template, app)
+    template_rendered.connect(_template_rendered, app)
+
+
+def _percentile(values, p):
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def report():
+    """每个路由的请求数, 耗时分位数(毫秒), 平均SQL条数和数据库耗时"""
+    with _samples_lock:
+        data = dict((route, list(samples)) for route, samples in _samples.items())
+    result = {}
+    for route, samples in data.items():
+        if not samples:
+            continue
+        totals = sorted(s[0] * 1000 for s in samples)
+        result[route] = {
+            'count': len(samples),
+            'p50': round(_percentile(totals, 50), 2),
+            'p95': round(_percentile(totals, 95), 2),
+            'p99': round(_percentile(totals, 99), 2),
+            'avg_statements': round(sum(s[1] for s in samples) / float(len(samples)), 2),
+            'avg_db_ms': round(sum(s[2] for s in samples) * 1000 / len(samples), 2),
+            'avg_template_ms': round(sum(s[3] for s in samples) * 1000 / len(samples), 2),
+        }
+    return result
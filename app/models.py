@@ -1,24 +1,131 @@
 # -*- coding: utf-8 -*-
+import re
 import html
+import time
 import hashlib
 from random import randint
 from datetime import datetime
 from . import db, login_manager
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask_login import UserMixin, AnonymousUserMixin
-from flask import current_app, request, url_for, abort
-from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from flask_login import UserMixin, AnonymousUserMixin, current_user
+from flask_sqlalchemy import BaseQuery
+from flask import current_app, url_for, abort, g, has_request_context
+import sqlalchemy
+from sqlalchemy.orm import load_only, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.ext.declarative import declared_attr
 from markdown import markdown
 import bleach
+from .cache import TTLCache
+from .passwords import hash_password, verify_and_rehash
+from .tokens import get_token_service
+from .routing import read_query
+
+
+GRAVATAR_URL = '//www.gravatar.com/avatar/'
+# 旧数据中保存的gravatar完整url
+_GRAVATAR_RE = re.compile(r'^https?://(?:secure|www)\.gravatar\.com/avatar/([0-9a-f]{32})')
+
+# Markdown 渲染后保留的标签, 其余的去掉
+MARKDOWN_ALLOWED_TAGS = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'i',
+                         'li', 'ol', 'pre', 'strong', 'ul', 'h1', 'h2', 'h3', 'h4',
+                         'h5', 'h6', 'p', 'br', 'hr']
+
+
+def render_markdown(text):
+    """把Markdown转换为HTML并清理
+        保存的 *_html 字段和页面上即时渲染都用这个函数, 结果一致
+    """
+    if text is None:
+        return None
+    return bleach.linkify(bleach.clean(markdown(text, output_format='html'),
+                                       tags=MARKDOWN_ALLOWED_TAGS, strip=True))
+
+
+def backfill_markdown(model, source, target, batch_size=500, force=False):
+    """为已有记录生成渲染后的HTML
+        force: 已经生成过的也重新渲染 (修改渲染规则后使用)
+        返回更新的记录数
+    """
+    source_column, target_column = getattr(model, source), getattr(model, target)
+    count = 0
+    last_id = 0
+    while True:
+        query = model.query.options(load_only('id', source, target)).filter(
+            model.id > last_id, source_column.isnot(None))
+        if not force:
+            query = query.filter(target_column.is_(None))
+        objs = query.order_by(model.id).limit(batch_size).all()
+        if not objs:
+            break
+        for obj in objs:
+            rendered = render_markdown(getattr(obj, source))
+            if rendered != getattr(obj, target):
+                setattr(obj, target, rendered)
+                count += 1
+        last_id = objs[-1].id
+        db.session.commit()
+    return count
+
+
+# 已登录用户和导航栏名称的缓存, 用户修改/禁用/删除时清除
+# 清除只在当前进程生效, 所以缓存项每隔 IDENTITY_REVALIDATE_INTERVAL 秒按主键查询一次
+# identity_version 确认记录没有变化, 其它进程禁用或删除用户后最多这么久生效
+_identity_cache = TTLCache(ttl=300)
+_names_cache = TTLCache(ttl=300)
+
+# 默认的重新校验间隔 (秒), 应小于 IDENTITY_CACHE_TTL
+DEFAULT_REVALIDATE_INTERVAL = 30
+
+
+def _cached_get(model, id):
+    """按主键取出用户, 命中缓存且还没到重新校验时间时不查询数据库"""
+    key = (model.__tablename__, id)
+    entry = _identity_cache.get(key)
+    if entry is not None:
+        now = time.monotonic()
+        interval = current_app.config.get('IDENTITY_REVALIDATE_INTERVAL',
+                                          DEFAULT_REVALIDATE_INTERVAL)
+        if now - entry['checked'] >= interval:
+            version = db.session.query(model.identity_version).filter(
+                model.id == id).scalar()
+            if version != entry['values']['identity_version']:
+                # 已删除或在其它进程中修改过
+                _identity_cache.pop(key)
+                entry = None
+            else:
+                entry['checked'] = now
+    if entry is not None:
+        obj = model.__mapper__.class_manager.new_instance()
+        for name, value in entry['values'].items():
+            set_committed_value(obj, name, value)
+        make_transient_to_detached(obj)
+        return db.session.merge(obj, load=False)
+    obj = model.query.get(id)
+    if obj is not None:
+        values = dict((attr.key, getattr(obj, attr.key))
+                      for attr in model.__mapper__.column_attrs)
+        _identity_cache.set(key, {'values': values, 'checked': time.monotonic()},
+                            ttl=current_app.config.get('IDENTITY_CACHE_TTL', 300))
+    return obj
+
+
+def invalidate_identity(model, id):
+    """清除某个用户的缓存"""
+    _identity_cache.pop((model.__tablename__, id))
+
+
+def invalidate_names():
+    """清除导航栏名称缓存"""
+    _names_cache.clear()
 
 
 @login_manager.user_loader
 def load_user(user_id):
     """使用flask_login时必须实现的函数 返回None或者实例"""
     if int(user_id) == 1:
-        return Administrator.query.get(int(user_id))
+        return _cached_get(Administrator, int(user_id))
     if int(user_id) >= 999:
-        return User.query.get(int(user_id))
+        return _cached_get(User, int(user_id))
     return None
 
 
@@ -46,6 +153,8 @@ class Administrator(UserMixin, db.Model):
     username = db.Column(db.String(32), nullable=False, unique=True)
     password_hash = db.Column(db.String(128))
     confirmed = db.Column(db.Boolean, default=True)
+    # 每次修改加1, 用于检查登录缓存是否过期
+    identity_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     @property
     def password(self):
@@ -53,11 +162,15 @@ class Administrator(UserMixin, db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def verify_password(self, password):
-        """验证密码，返回布尔值"""
-        return check_password_hash(self.password_hash, password)
+        """验证密码，返回布尔值 hash参数变化时重新hash, 需要调用方提交"""
+        verified, new_hash = verify_and_rehash(self.password_hash, password)
+        if new_hash is not None:
+            self.password_hash = new_hash
+            db.session.add(self)
+        return verified
 
     @staticmethod
     def register_admin():
@@ -69,9 +182,16 @@ class Administrator(UserMixin, db.Model):
         db.session.commit()
 
     def get_names(self):
-        names = []
-        for name in SecondPageName.query.all():
-            names.append((name.page_name, name.url))
+        names = getattr(g, '_page_names', None)
+        if names is None:
+            names = _names_cache.get('names')
+        if names is None:
+            names = []
+            for name in SecondPageName.query.all():
+                names.append((name.page_name, name.url))
+            _names_cache.set('names', names,
+                             ttl=current_app.config.get('IDENTITY_CACHE_TTL', 300))
+        g._page_names = names
         return names
 
     @staticmethod
@@ -88,9 +208,9 @@ class User(db.Model, UserMixin):
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
         if self.email is not None and self.avatar_hash is None:
-            self.avatar_hash = self.gravatar()
+            self.avatar_hash = self.email_hash(self.email)
 
-    # 头像hash
+    # 头像hash 保存邮箱的md5, 或者用户自己上传的头像url
     avatar_hash = db.Column(db.Text)
 
     __tablename__ = 'users'
@@ -117,9 +237,15 @@ class User(db.Model, UserMixin):
     weight = db.Column(db.Integer)
     position = db.Column(db.String(16))
     about_me = db.Column(db.Text)
+    # about_me 渲染后的HTML, 修改 about_me 时自动生成
+    about_me_html = db.Column(db.Text)
     qq = db.Column(db.Integer)
     WeChat = db.Column(db.String(16))
     confirmed = db.Column(db.Boolean, default=False)
+    # 未读信息数 由Info的事件维护
+    unread_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # 每次修改加1, 用于检查登录缓存是否过期
+    identity_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     
     @staticmethod
     def is_user():
@@ -131,11 +257,15 @@ class User(db.Model, UserMixin):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def verify_password(self, password):
-        """验证密码，返回布尔值"""
-        return check_password_hash(self.password_hash, password)
+        """验证密码，返回布尔值 hash参数变化时重新hash, 需要调用方提交"""
+        verified, new_hash = verify_and_rehash(self.password_hash, password)
+        if new_hash is not None:
+            self.password_hash = new_hash
+            db.session.add(self)
+        return verified
 
     @staticmethod
     def is_position(value):
@@ -157,22 +287,33 @@ class User(db.Model, UserMixin):
 
     def generate_confirmation_token(self, expiration=3600):
         """生成一个验证用token 持续时间为1天"""
-        s = Serializer(current_app.config['SECRET_KEY'], expires_in=expiration)
-        return s.dumps({'confirm': self.id})
+        return get_token_service().dumps({'confirm': self.id}, expires_in=expiration)
 
     def confirm(self, token):
         """验证token的值"""
-        s = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            data = s.loads(token)
-        except:
-            return False
-        if data.get('confirm') != self.id:
+        data = get_token_service().loads(token)
+        if data is None or data.get('confirm') != self.id:
             return False
         self.confirmed = True
         db.session.add(self)
         return True
 
+    @staticmethod
+    def confirm_many(tokens):
+        """批量验证token, 用一条UPDATE确认所有有效的用户, 返回确认的用户id"""
+        ids = set()
+        for data, outcome in get_token_service().verify_many(tokens):
+            if data is not None and data.get('confirm') is not None:
+                ids.add(data['confirm'])
+        if ids:
+            # 批量UPDATE不触发 before_update, 版本号在这里增加
+            User.query.filter(User.id.in_(ids)).update(
+                {User.confirmed: True, User.identity_version: User.identity_version + 1},
+                synchronize_session=False)
+            for id in ids:
+                invalidate_identity(User, id)
+        return sorted(ids)
+
     def get_info(self):
         """返回用户收到的信息"""
         return {'info': self.infos}
@@ -194,21 +335,24 @@ class User(db.Model, UserMixin):
             'weight': self.weight,
             'position': self.position,
             'about_me': self.about_me,
-            'avatar_hash': self.avatar_hash
+            'about_me_html': self.about_me_html,
+            'avatar_hash': self.gravatar()
         }
         return json_data
 
-    def easy_to_json(self):
+    def easy_to_json(self, avatar=True):
         """返回不保密的用户信息"""
         json_data = {
             'id': self.id,
             'username': self.username,
-            'avatar_hash': self.avatar_hash,
             'nickname': self.nickname,
             'position': self.position,
             'about_me': self.about_me,
+            'about_me_html': self.about_me_html,
             'auth_url': url_for('auth.index', id=self.id)
         }
+        if avatar:
+            json_data['avatar_hash'] = self.gravatar()
         return json_data
 
     @staticmethod
@@ -221,7 +365,10 @@ class User(db.Model, UserMixin):
             user.username = data.get('username')
             user.email = data.get('email')
             user.password = data.get('password')
-        user.avatar_hash = data.get('avatar') or user.gravatar()
+        if data.get('avatar'):
+            user.avatar_hash = data.get('avatar')
+        elif user.avatar_hash is None and user.email is not None:
+            user.avatar_hash = User.email_hash(user.email)
         user.phone = data.get('phone')
         user.qq = data.get('qq')
         user.WeChat = data.get('WeChat')
@@ -237,39 +384,116 @@ class User(db.Model, UserMixin):
         return user
 
     
+    @staticmethod
+    def email_hash(email):
+        """邮箱的md5, 注册或修改邮箱时计算一次"""
+        return hashlib.md5(email.lower().encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def avatar_url_builder(size=128, default='identicon', rating='g'):
+        """返回一个由头像hash生成url的函数, 批量生成时参数只格式化一次"""
+        suffix = '?s={size}&d={default}&r={rating}'.format(
+            size=size, default=default, rating=rating)
+
+        def build(avatar_hash):
+            if avatar_hash is None:
+                return None
+            if '/' in avatar_hash:  # 用户自己设置的头像url
+                return avatar_hash
+            return GRAVATAR_URL + avatar_hash + suffix
+        return build
+
     def gravatar(self, size=128, default='identicon', rating='g'):
         """使用gravatar生成用户头像"""
-        if self.avatar_hash is not None:
-            return self.avatar_hash
-        if request.is_secure:  # 如果响应是安全的
-            url = 'https://secure.gravatar.com/avatar'
-        else:
-            url = 'http://www.gravatar.com/avatar'
-        my_hash = hashlib.md5(self.email.encode(
-            'utf-8')).hexdigest()
-        return '{url}/{hash}?s={size}&d={default}&r={rating}'.format(
-            url=url, hash=my_hash, size=size, default=default, rating=rating
-        )
+        return User.avatar_url_builder(size, default, rating)(self.avatar_hash)
+
+    @staticmethod
+    def easy_to_json_list(users):
+        """批量返回不保密的用户信息"""
+        build = User.avatar_url_builder()
+        result = []
+        for user in users:
+            json_data = user.easy_to_json(avatar=False)
+            json_data['avatar_hash'] = build(user.avatar_hash)
+            result.append(json_data)
+        return result
+
+    @staticmethod
+    def backfill_avatar_hash(batch_size=1000):
+        """把旧数据中保存的gravatar完整url换成邮箱hash, 没有头像的按邮箱补上"""
+        count = 0
+        last_id = 0
+        while True:
+            users = User.query.filter(User.id > last_id).order_by(User.id).limit(batch_size).all()
+            if not users:
+                break
+            for user in users:
+                avatar_hash = user.avatar_hash
+                match = _GRAVATAR_RE.match(avatar_hash or '')
+                if match:
+                    avatar_hash = match.group(1)
+                elif avatar_hash is None and user.email is not None:
+                    avatar_hash = User.email_hash(user.email)
+                if avatar_hash != user.avatar_hash:
+                    user.avatar_hash = avatar_hash
+                    count += 1
+            last_id = users[-1].id
+            db.session.commit()
+        return count
 
     @staticmethod
     def get_user_id(token):
         """通过token获取用户id"""
-        s = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            data = s.loads(token)
-        except:
-            return None
-        return data.get('confirm')
+        data = get_token_service().loads(token)
+        return data.get('confirm') if data is not None else None
+
+
+def _on_email_changed(target, value, oldvalue, initiator):
+    """修改邮箱时重新计算头像hash, 用户自己设置的头像不变"""
+    if value is not None and (target.avatar_hash is None or '/' not in target.avatar_hash):
+        target.avatar_hash = User.email_hash(value)
+
+
+db.event.listen(User.email, 'set', _on_email_changed)
+
+
+def _on_about_me_changed(target, value, oldvalue, initiator):
+    """修改 about_me 时重新渲染"""
+    target.about_me_html = render_markdown(value)
+
+
+db.event.listen(User.about_me, 'set', _on_about_me_changed)
+
+
+def _bump_identity_version(mapper, connection, target):
+    """字段有变化时增加版本号, 让其它进程的登录缓存失效"""
+    if db.object_session(target).is_modified(target, include_collections=False):
+        target.identity_version = (target.identity_version or 0) + 1
+
+
+def _on_identity_changed(mapper, connection, target):
+    invalidate_identity(type(target), target.id)
+
+
+for _model in (Administrator, User):
+    db.event.listen(_model, 'before_update', _bump_identity_version)
+    db.event.listen(_model, 'after_update', _on_identity_changed)
+    db.event.listen(_model, 'after_delete', _on_identity_changed)
 
 
 class Info(db.Model):
     """用户接受的信息"""
     __tablename__ = 'info'
+    __table_args__ = (
+        db.Index('ix_info_user_read_timestamp', 'user_id', 'is_read', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    # 修改时先取出旧值, 未读数按旧值增减
+    user_id = db.column_property(db.Column(db.Integer, db.ForeignKey('users.id')),
+                                 active_history=True)
     message = db.Column(db.Text)
-    is_read = db.Column(db.Boolean, default=False)
-    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow())
+    is_read = db.column_property(db.Column(db.Boolean, default=False), active_history=True)
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
     def to_json(self):
         json_data = {
@@ -288,6 +512,101 @@ class Info(db.Model):
         self.is_read = True
         db.session.add(self)
 
+    @staticmethod
+    def mark_read(user_id, start=None, end=None):
+        """用一条UPDATE把用户的信息标记为已读, 可以只标记 [start, end] 时间段内的
+            返回标记的条数
+        """
+        query = Info.query.filter(Info.user_id == user_id, Info.is_read == False)
+        if start is not None:
+            query = query.filter(Info.timestamp >= start)
+        if end is not None:
+            query = query.filter(Info.timestamp <= end)
+        count = query.update({Info.is_read: True}, synchronize_session=False)
+        if count:
+            # 批量UPDATE不触发 before_update, 版本号在这里增加
+            User.query.filter_by(id=user_id).update(
+                {User.unread_count: User.unread_count - count,
+                 User.identity_version: User.identity_version + 1},
+                synchronize_session=False)
+            invalidate_identity(User, user_id)
+        return count
+
+    @staticmethod
+    def inbox(user_id, cursor=None, limit=20, unread_only=False):
+        """按时间倒序分页列出用户的信息
+            cursor: 上一页返回的游标
+            返回 {'items': [...], 'next': 下一页游标或None}
+        """
+        query = Info.query.filter(Info.user_id == user_id)
+        if unread_only:
+            query = query.filter(Info.is_read == False)
+        if cursor:
+            timestamp, _, id = cursor.rpartition('_')
+            timestamp = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f')
+            query = query.filter(db.or_(
+                Info.timestamp < timestamp,
+                db.and_(Info.timestamp == timestamp, Info.id < int(id))))
+        rows = query.order_by(Info.timestamp.desc(), Info.id.desc()).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = None
+        if has_more:
+            last = rows[-1]
+            next_cursor = '%s_%d' % (last.timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f'), last.id)
+        return {'items': [info.to_json() for info in rows], 'next': next_cursor}
+
+    @staticmethod
+    def recount_unread():
+        """按Info表重新计算所有用户的未读数"""
+        unread = db.select([db.func.count(Info.id)]).where(
+            db.and_(Info.user_id == User.id, Info.is_read == False)).as_scalar()
+        User.query.update({User.unread_count: unread,
+                           User.identity_version: User.identity_version + 1},
+                          synchronize_session=False)
+        db.session.commit()
+        _identity_cache.clear()
+
+
+def _change_unread(connection, user_id, delta):
+    if user_id is not None and delta:
+        users = User.__table__
+        connection.execute(users.update().where(users.c.id == user_id).values(
+            unread_count=users.c.unread_count + delta,
+            identity_version=users.c.identity_version + 1))
+        invalidate_identity(User, user_id)
+
+
+def _info_inserted(mapper, connection, target):
+    if not target.is_read:
+        _change_unread(connection, target.user_id, 1)
+
+
+def _info_updated(mapper, connection, target):
+    """已读状态或接收用户变化时, 旧用户按旧状态减, 新用户按新状态加"""
+    attrs = db.inspect(target).attrs
+    read_history, user_history = attrs.is_read.history, attrs.user_id.history
+    if not (read_history.has_changes() or user_history.has_changes()):
+        return
+    old_read = read_history.deleted[0] if read_history.deleted else target.is_read
+    old_user = user_history.deleted[0] if user_history.deleted else target.user_id
+    if old_user == target.user_id and bool(old_read) == bool(target.is_read):
+        return
+    if not old_read:
+        _change_unread(connection, old_user, -1)
+    if not target.is_read:
+        _change_unread(connection, target.user_id, 1)
+
+
+def _info_deleted(mapper, connection, target):
+    if not target.is_read:
+        _change_unread(connection, target.user_id, -1)
+
+
+db.event.listen(Info, 'after_insert', _info_inserted)
+db.event.listen(Info, 'after_update', _info_updated)
+db.event.listen(Info, 'after_delete', _info_deleted)
+
 
 class Bilu(db.Model):
     """笔录模版"""
@@ -295,6 +614,8 @@ class Bilu(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(32), default='标题')
     body = db.Column(db.Text)
+    # body 渲染后的HTML, 修改 body 时自动生成
+    body_html = db.Column(db.Text)
     act_date = db.Column(db.DateTime, index=True)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow())
 
@@ -303,6 +624,7 @@ class Bilu(db.Model):
             'id': self.id,
             'title': self.title,
             'body': self.body,
+            'body_html': self.body_html,
             'act_date': datetime.strftime(self.act_date, '%Y-%m-%d'),
             'timestamp': self.timestamp,
             'api_url': url_for('api.delete_bilu', id=self.id),
@@ -311,6 +633,7 @@ class Bilu(db.Model):
         }
         if brief:
             json_data.pop('body')
+            json_data.pop('body_html')
         return json_data
 
     @staticmethod
@@ -326,6 +649,81 @@ class Bilu(db.Model):
             'act_date'), '%Y-%m-%d')
         return obj
 
+    @staticmethod
+    def on_changed_body(target, value, oldvalue, initiator):
+        target.body_html = render_markdown(value)
+
+db.event.listen(Bilu.body, 'set', Bilu.on_changed_body)
+
+class ChangeLog(db.Model):
+    """案件相关表的变更记录 只追加, seq 递增"""
+    __tablename__ = 'change_log'
+    # sqlite 默认复用最大的rowid, 清理后seq会从小的值重新开始, 消费者会漏掉这些变更
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    table_name = db.Column(db.String(64), nullable=False)
+    row_key = db.Column(db.String(128), nullable=False)
+    # 所属案件编号, 行被删除后仍能找到受影响的案件
+    case_num = db.Column(db.String(128))
+    # 修改了所属案件时的原案件编号
+    old_case_num = db.Column(db.String(128))
+    # I 新增 U 修改 D 删除
+    op = db.Column(db.CHAR(1), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def to_json(self):
+        return {
+            'seq': self.seq,
+            'table_name': self.table_name,
+            'row_key': self.row_key,
+            'case_num': self.case_num,
+            'old_case_num': self.old_case_num,
+            'op': self.op,
+            'timestamp': self.timestamp,
+        }
+
+
+class ChangeOffset(db.Model):
+    """变更记录的消费位置 每个消费者一行"""
+    __tablename__ = 'change_offsets'
+    consumer = db.Column(db.String(64), primary_key=True)
+    seq = db.Column(db.Integer, nullable=False, default=0)
+
+
+class CaseSummary(db.Model):
+    """案件汇总表 由 app/summary.py 根据变更记录维护, 不要直接修改"""
+    __tablename__ = 'case_summary'
+    low_case_num = db.Column(db.VARCHAR(128), primary_key=True)
+    # 审批法院, 截取前255个字符以便建索引
+    court = db.Column(db.VARCHAR(255))
+    # 判决年份
+    decision_year = db.Column(db.Integer)
+    # 执行法官编号
+    judge = db.Column(db.VARCHAR(64))
+    bill_count = db.Column(db.Integer, nullable=False, default=0)
+    comment_count = db.Column(db.Integer, nullable=False, default=0)
+    # 案件、起诉意见书和批注中最新的修改时间
+    latest_update = db.Column(db.DateTime)
+    refreshed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_case_summary_court_year', 'court', 'decision_year'),
+        db.Index('ix_case_summary_year', 'decision_year'),
+        db.Index('ix_case_summary_judge', 'judge'),
+    )
+
+    def to_json(self):
+        return {
+            'low_case_num': self.low_case_num,
+            'court': self.court,
+            'decision_year': self.decision_year,
+            'judge': self.judge,
+            'bill_count': self.bill_count,
+            'comment_count': self.comment_count,
+            'latest_update': self.latest_update,
+            'refreshed_at': self.refreshed_at,
+        }
+
 #测试 
 # def test():
 #     db.reflect()
@@ -339,10 +737,178 @@ class Bilu(db.Model):
 #     District=db.Column(db.String(20),nullable=False,default='')
 #     Population=db.Column(db.Integer,nullable=False,default='0')
 
-class comment_info(db.Model):
+def keyset_page(model, key, after=None, limit=50, brief=True, fields=None):
+    """按主键做游标分页, 只加载需要的列
+        after: 上一页最后一条的主键, 为空时从头开始
+        brief: 不加载 model.BRIEF_EXCLUDE 中的大文本字段
+        fields: 只返回指定的字段
+        返回 {'items': [...], 'next': 下一页游标或None}
+    """
+    key_column = getattr(model, key)
+    if fields:
+        names = [c.name for c in model.__table__.columns if c.name in fields]
+    else:
+        excluded = model.BRIEF_EXCLUDE if brief else ()
+        names = [c.name for c in model.__table__.columns if c.name not in excluded]
+    if key not in names:
+        names.insert(0, key)
+    query = read_query(model).options(load_only(*names)).order_by(key_column)
+    if after is not None:
+        query = query.filter(key_column > after)
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if fields:
+        items = [dict((name, getattr(obj, name)) for name in names) for obj in rows]
+    else:
+        items = [obj.to_json(brief=brief) for obj in rows]
+    return {
+        'items': items,
+        'next': getattr(rows[-1], key) if has_more else None,
+    }
+
+
+# 有效记录
+RECORD_ACTIVE = '1'
+# 已删除记录
+RECORD_DELETED = '0'
+
+
+# ActiveQuery 依赖 SQLAlchemy 1.3 的 Query 内部方法 (_compile_context, _mapper_zero,
+# _enable_assertions), 1.4 中这些方法改变, 默认条件会静默失效, 所以限定 SQLAlchemy<1.4
+if tuple(int(v) for v in sqlalchemy.__version__.split('.')[:2]) >= (1, 4):
+    raise ImportError('需要 SQLAlchemy<1.4, 当前版本为 %s' % sqlalchemy.__version__)
+
+
+class ActiveQuery(BaseQuery):
+    """默认只查询有效记录(record_status='1'), with_inactive() 查询全部记录
+        条件在生成SQL时才加上, 所以 with_inactive() 保留之前的过滤、排序和选项
+        lazy='dynamic' 的关系需要指定 query_class=ActiveQuery 才有默认条件
+    """
+    _with_inactive = False
+
+    def with_inactive(self):
+        """包括已删除的记录"""
+        query = self._clone()
+        query._with_inactive = True
+        return query
+
+    def _active(self):
+        """加上有效记录条件后的查询"""
+        if self._with_inactive:
+            return self
+        assertions = self._enable_assertions
+        # limit/offset 之后不允许再 filter, 这里的条件和已有条件是同一层的 WHERE
+        query = self.enable_assertions(False)
+        query._with_inactive = True
+        mapper = self._mapper_zero()
+        if mapper is not None and hasattr(mapper.class_, 'record_status'):
+            query = query.filter(mapper.class_.record_status == RECORD_ACTIVE)
+        return query.enable_assertions(assertions)
+
+    def _compile_context(self, labels=True):
+        return super(ActiveQuery, self._active())._compile_context(labels)
+
+    def from_self(self, *entities):
+        # count() 等通过子查询实现, 条件加在子查询中
+        return super(ActiveQuery, self._active()).from_self(*entities)
+
+    def update(self, *args, **kwargs):
+        return super(ActiveQuery, self._active()).update(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return super(ActiveQuery, self._active()).delete(*args, **kwargs)
+
+    def get(self, ident):
+        # 带过滤条件的查询不能直接调用get
+        obj = super(ActiveQuery, self.with_inactive()).get(ident)
+        if obj is None or self._with_inactive or obj.record_status == RECORD_ACTIVE:
+            return obj
+        return None
+
+
+class AuditMixin(object):
+    """记录状态和创建/修改信息
+        新增和修改的记录在flush时自动填写, 调用方明确设置的值不覆盖
+        Model.query 默认只查询有效记录
+    """
+    query_class = ActiveQuery
+
+    AUDIT_FIELDS = ('record_status', 'create_datetime', 'create_by',
+                    'update_datetime', 'update_by')
+
+    record_status = db.Column(db.CHAR(1), nullable=False, default=RECORD_ACTIVE)
+    create_datetime = db.Column(db.TIMESTAMP(), nullable=False)
+    create_by = db.Column(db.VARCHAR(128), nullable=False)
+    update_datetime = db.Column(db.TIMESTAMP(), nullable=False)
+    update_by = db.Column(db.VARCHAR(128), nullable=False)
+
+    # 子类的其它索引
+    __indexes__ = ()
+
+    @declared_attr
+    def __table_args__(cls):
+        return tuple(cls.__indexes__) + (
+            # 按状态和修改时间查询
+            db.Index('ix_%s_status_updated' % cls.__name__, 'record_status', 'update_datetime'),
+            # 有效记录按修改时间排序, 支持部分索引的数据库只索引有效记录
+            db.Index('ix_%s_active_updated' % cls.__name__, 'update_datetime',
+                     postgresql_where=db.text("record_status = '1'"),
+                     sqlite_where=db.text("record_status = '1'")),
+        )
+
+    def update_audit_from_json(self, json_data):
+        """json中有的记录字段才更新, 其余在flush时自动填写"""
+        for name in self.AUDIT_FIELDS:
+            if json_data.get(name) is not None:
+                setattr(self, name, json_data.get(name))
+
+    def soft_delete(self):
+        """标记为已删除"""
+        self.record_status = RECORD_DELETED
+        db.session.add(self)
+
+
+def _audit_user():
+    """当前操作的用户名"""
+    if has_request_context() and current_user.is_authenticated:
+        return current_user.username
+    return 'system'
+
+
+def _stamp_audit(session, flush_context, instances):
+    """flush前填写记录状态和创建/修改信息"""
+    now = None
+    for obj in session.new:
+        if isinstance(obj, AuditMixin):
+            now = now or datetime.utcnow()
+            user = _audit_user()
+            if obj.record_status is None:
+                obj.record_status = RECORD_ACTIVE
+            obj.create_datetime = obj.create_datetime or now
+            obj.create_by = obj.create_by or user
+            obj.update_datetime = obj.update_datetime or now
+            obj.update_by = obj.update_by or user
+    for obj in session.dirty:
+        if isinstance(obj, AuditMixin) and session.is_modified(obj, include_collections=False):
+            attrs = db.inspect(obj).attrs
+            now = now or datetime.utcnow()
+            if not attrs.update_datetime.history.has_changes():
+                obj.update_datetime = now
+            if not attrs.update_by.history.has_changes():
+                obj.update_by = _audit_user()
+
+
+db.event.listen(db.session, 'before_flush', _stamp_audit)
+
+
+class comment_info(AuditMixin, db.Model):
     '''批注信息表'''
+    __indexes__ = (
+        db.Index('ix_comment_info_entity', 'comment_entity_type', 'comment_entity_num'),
+    )
     #案件编号,外键
-    low_case_num=db.Column(db.VARCHAR(128),nullable=False)
+    low_case_num=db.Column(db.VARCHAR(128),nullable=False,index=True)
     #批注编号，主键
     comment_num = db.Column(db.VARCHAR(128), nullable=False,primary_key=True)
     #批注实体类型
@@ -352,13 +918,6 @@ class comment_info(db.Model):
     #批注内容
     comment_text = db.Column(db.TEXT(), nullable=False)
 
-    #记录
-    record_status = db.Column(db.CHAR(1), nullable=False)
-    create_datetime = db.Column(db.TIMESTAMP(), nullable=False)
-    create_by = db.Column(db.VARCHAR(128), nullable=False)
-    update_datetime = db.Column(db.TIMESTAMP(), nullable=False)
-    update_by = db.Column(db.VARCHAR(128), nullable=False)
-
     def to_json(self, brief=False):
         json_data = {
             'low_case_num':self.low_case_num,
@@ -372,6 +931,7 @@ class comment_info(db.Model):
             'update_datetime': self.update_datetime,
             'update_by': self.update_by,
         }
+        return json_data
 
     @staticmethod
     def fom_json(self,json_data):
@@ -385,14 +945,10 @@ class comment_info(db.Model):
         obj.comment_entity_type = json_data.get('comment_entity_type')
         obj.comment_entity_num = json_data.get('comment_entity_num')
         obj.comment_text = json_data.get('comment_text')
-        obj.record_status = json_data.get('record_status')
-        obj.create_datetime = json_data.get('create_datetime')
-        obj.create_by = json_data.get('create_by')
-        obj.update_datetime = json_data.get('update_datetime')
-        obj.update_by = json_data.get('update_by')
+        obj.update_audit_from_json(json_data)
         return obj
 
-class law_case_info(db.Model):
+class law_case_info(AuditMixin, db.Model):
     '''案件信息表'''
     #案件编号
     low_case_num = db.Column(db.VARCHAR(128), nullable=False,primary_key=True)
@@ -412,19 +968,22 @@ class law_case_info(db.Model):
     low_case_defence_counsel=db.Column(db.VARCHAR(64), nullable=False)
     #案件名称
     low_case_name=db.Column(db.VARCHAR(128), nullable=False)
-    #记录
-    record_status = db.Column(db.CHAR(1), nullable=False)
-    create_datetime = db.Column(db.TIMESTAMP(), nullable=False)
-    create_by = db.Column(db.VARCHAR(128), nullable=False)
-    update_datetime = db.Column(db.TIMESTAMP(), nullable=False)
-    update_by = db.Column(db.VARCHAR(128), nullable=False)
+    #起诉意见书
+    bills = db.relationship('indictment_bill_info', backref='case', lazy='dynamic',
+                            query_class=ActiveQuery)
+    #批注
+    comments = db.relationship('comment_info', lazy='dynamic', viewonly=True,
+                               query_class=ActiveQuery,
+                               primaryjoin='law_case_info.low_case_num == foreign(comment_info.low_case_num)')
+
+    # 列表(brief)中不加载的大文本字段
+    BRIEF_EXCLUDE = ('low_case_content', 'low_case_court')
 
     def to_json(self, brief=False):
         json_data={
             'low_case_num':self.low_case_num,
             'low_case_reason':self.low_case_reason,
             'low_case_party':self.low_case_party,
-            'low_case_court':self.low_case_court,
             'low_case_decision_time':self.low_case_decision_time,
             'low_case_executive_judge':self.low_case_executive_judge,
             'low_case_defence_counsel':self.low_case_defence_counsel,
@@ -435,13 +994,64 @@ class law_case_info(db.Model):
             'update_datetime':self.update_datetime,
             'update_by':self.update_by,
         }
+        if not brief:
+            json_data['low_case_court'] = self.low_case_court
         return json_data
 
     @staticmethod
     def queryBy_low_case_num(key):
-        m=law_case_info.query.filter_by(low_case_num=key).first()
+        m=read_query(law_case_info).filter_by(low_case_num=key).first()
         return m.to_json()
 
+    @staticmethod
+    def load_aggregates(keys, brief=False):
+        """一次取出多个案件及其起诉意见书和批注, 共三次查询
+            批注按 (批注实体类型, 批注实体编号) 分组
+            返回 {案件编号: {'case': ..., 'bills': [...], 'comments': [...]}}
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        result = {}
+        for case in read_query(law_case_info).filter(law_case_info.low_case_num.in_(keys)):
+            result[case.low_case_num] = {'case': case.to_json(brief=brief),
+                                         'bills': [], 'comments': []}
+        if not result:
+            return result
+        bills = read_query(indictment_bill_info).filter(
+            indictment_bill_info.low_case_num.in_(list(result))).order_by(
+            indictment_bill_info.low_case_num, indictment_bill_info.bill_num)
+        for bill in bills:
+            result[bill.low_case_num]['bills'].append(bill.to_json(brief=brief))
+        groups = {}
+        comments = read_query(comment_info).filter(
+            comment_info.low_case_num.in_(list(result))).order_by(
+            comment_info.low_case_num, comment_info.comment_entity_type,
+            comment_info.comment_entity_num, comment_info.create_datetime)
+        for comment in comments:
+            group_key = (comment.low_case_num, comment.comment_entity_type,
+                         comment.comment_entity_num)
+            group = groups.get(group_key)
+            if group is None:
+                group = groups[group_key] = {
+                    'entity_type': comment.comment_entity_type,
+                    'entity_num': comment.comment_entity_num,
+                    'comments': [],
+                }
+                result[comment.low_case_num]['comments'].append(group)
+            group['comments'].append(comment.to_json())
+        return result
+
+    @staticmethod
+    def load_aggregate(key, brief=False):
+        """取出一个案件及其起诉意见书和批注, 没有时返回None"""
+        return law_case_info.load_aggregates([key], brief=brief).get(key)
+
+    @staticmethod
+    def list_page(after=None, limit=50, brief=True, fields=None):
+        """按案件编号分页列出案件"""
+        return keyset_page(law_case_info, 'low_case_num', after, limit, brief, fields)
+
     @staticmethod
     def fom_json(json_data):
         low_case_num=json_data.get('low_case_num')
@@ -449,26 +1059,28 @@ class law_case_info(db.Model):
             obj = law_case_info.query.get_or_404(low_case_num)
         else:
             obj = law_case_info()
-        obj.low_case_reason = json_data.get('low_case_reason')
-        obj.low_case_party = json_data.get('low_case_party')
-        obj.low_case_court = json_data.get('low_case_court')
-        obj.low_case_decision_time = json_data.get('low_case_decision_time')
-        obj.low_case_executive_judge = json_data.get('low_case_executive_judge')
-        obj.low_case_defence_counsel = json_data.get('low_case_defence_counsel')
-        obj.low_case_name = json_data.get('low_case_name')
-        obj.record_status = json_data.get('record_status')
-        obj.create_datetime = json_data.get('create_datetime')
-        obj.create_by = json_data.get('create_by')
-        obj.update_datetime = json_data.get('update_datetime')
-        obj.update_by = json_data.get('update_by')
+        obj.update_from_json(json_data)
         return obj
 
+    def update_from_json(self, json_data):
+        """按json字段更新当前记录"""
+        self.low_case_reason = json_data.get('low_case_reason')
+        self.low_case_party = json_data.get('low_case_party')
+        if 'low_case_content' in json_data:
+            self.low_case_content = json_data.get('low_case_content')
+        self.low_case_court = json_data.get('low_case_court')
+        self.low_case_decision_time = json_data.get('low_case_decision_time')
+        self.low_case_executive_judge = json_data.get('low_case_executive_judge')
+        self.low_case_defence_counsel = json_data.get('low_case_defence_counsel')
+        self.low_case_name = json_data.get('low_case_name')
+        self.update_audit_from_json(json_data)
+
     @staticmethod
     def insert(m):
         db.session.add(m)
         db.session.commit()
 
-class indictment_bill_info(db.Model):
+class indictment_bill_info(AuditMixin, db.Model):
     """起诉意见书管理"""
     # __tablename__ = 'indictment_bill_info'
     # id = db.Column(db.Integer, primary_key=True)
@@ -489,13 +1101,13 @@ class indictment_bill_info(db.Model):
     # 事实与理由
     bill_fact_and_reason = db.Column(db.TEXT(),nullable=False)
 
-    # 记录
-    record_status = db.Column(db.CHAR(1),nullable=False,default='1')
-    create_datetime = db.Column(db.TIMESTAMP(),nullable=False)
+    # 记录 创建人/修改人比其它表短
     create_by = db.Column(db.VARCHAR(64))
-    update_datetime = db.Column(db.TIMESTAMP() ,nullable=False)
     update_by = db.Column(db.VARCHAR(64),nullable=False)
 
+    # 列表(brief)中不加载的大文本字段
+    BRIEF_EXCLUDE = ('bill_claim', 'bill_fact_and_reason')
+
     def to_json(self, brief=False):
         json_data = {
             'low_case_num':self.low_case_num,
@@ -504,21 +1116,27 @@ class indictment_bill_info(db.Model):
             'bill_demandant':self.bill_demandant,
             'bill_third_party':self.bill_third_party,
             'bill_prosecutor':self.bill_prosecutor,
-            'bill_claim':self.bill_claim,
-            'bill_fact_and_reason':self.bill_fact_and_reason,
             'record_status':self.record_status,
             'create_datetime':self.create_datetime,
             'create_by':self.create_by,
             'update_datetime':self.update_datetime,
             'update_by':self.update_by,
         }
+        if not brief:
+            json_data['bill_claim'] = self.bill_claim
+            json_data['bill_fact_and_reason'] = self.bill_fact_and_reason
         return json_data
 
     @staticmethod
     def queryBy_low_case_num(key):
-        m=indictment_bill_info.query.filter_by(bill_num=key).first()
+        m=read_query(indictment_bill_info).filter_by(bill_num=key).first()
         return m.to_json()
 
+    @staticmethod
+    def list_page(after=None, limit=50, brief=True, fields=None):
+        """按文书编号分页列出起诉意见书"""
+        return keyset_page(indictment_bill_info, 'bill_num', after, limit, brief, fields)
+
     @staticmethod
     def from_json(json_data):
         bill_num = json_data.get('bill_num')
@@ -526,20 +1144,20 @@ class indictment_bill_info(db.Model):
             obj = indictment_bill_info.query.get_or_404(bill_num)
         else:
             obj = indictment_bill_info()
-        obj.low_case_num  = json_data.get('low_case_num')
-        obj.bill_plaintiff = json_data.get('bill_plaintiff')
-        obj.bill_demandant = json_data.get('bill_demandant')
-        obj.bill_third_party = json_data.get('bill_third_party')
-        obj.bill_prosecutor = json_data.get('bill_prosecutor')
-        obj.bill_claim = json_data.get('bill_claim')
-        obj.bill_fact_and_reason = json_data.get('bill_fact_and_reason')
-        obj.record_status = json_data.get('record_status')
-        obj.create_datetime = json_data.get('create_datetime')
-        obj.create_by = json_data.get('create_by')
-        obj.update_datetime = json_data.get('update_datetime')
-        obj.update_by = json_data.get('update_by')
+        obj.update_from_json(json_data)
         return obj
 
+    def update_from_json(self, json_data):
+        """按json字段更新当前记录"""
+        self.low_case_num  = json_data.get('low_case_num')
+        self.bill_plaintiff = json_data.get('bill_plaintiff')
+        self.bill_demandant = json_data.get('bill_demandant')
+        self.bill_third_party = json_data.get('bill_third_party')
+        self.bill_prosecutor = json_data.get('bill_prosecutor')
+        self.bill_claim = json_data.get('bill_claim')
+        self.bill_fact_and_reason = json_data.get('bill_fact_and_reason')
+        self.update_audit_from_json(json_data)
+
     @staticmethod
     def insert(m):
         db.session.add(m)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""密码hash
+    hash参数由 PASSWORD_HASH_METHOD / PASSWORD_SALT_LENGTH 配置, 参数变化后用户下次登录时自动重新hash.
+    验证在一个有界线程池 (PASSWORD_VERIFY_WORKERS) 中执行, 同时排队的验证超过
+    PASSWORD_VERIFY_QUEUE 个时直接拒绝, 避免登录高峰占满所有请求线程; 登录时的重新hash
+    也在这个线程池中执行.
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordVerifyBusy(Exception):
+    """等待验证的请求太多"""
+
+
+def _hash_options():
+    """按配置生成 generate_password_hash 的参数"""
+    config = current_app.config
+    kwargs = {}
+    if config.get('PASSWORD_HASH_METHOD'):
+        kwargs['method'] = config['PASSWORD_HASH_METHOD']
+    if config.get('PASSWORD_SALT_LENGTH'):
+        kwargs['salt_length'] = config['PASSWORD_SALT_LENGTH']
+    return kwargs
+
+
+def hash_password(password):
+    """按配置的参数生成密码hash"""
+    return generate_password_hash(password, **_hash_options())
+
+
+# 配置的参数 -> (hash前缀, salt长度), 生成一次hash得到, 前缀包含werkzeug补全的迭代次数
+_expected_params = {}
+
+
+def _hash_params(pwhash):
+    method, _, rest = pwhash.partition('$')
+    return method, len(rest.partition('$')[0])
+
+
+def needs_rehash(pwhash):
+    """已保存的hash是否使用了不同的参数
+        与按当前配置生成的hash比较前缀和salt长度, PASSWORD_HASH_METHOD 可以只写
+        'pbkdf2:sha256', 迭代次数按werkzeug的默认值比较
+    """
+    kwargs = _hash_options()
+    if not kwargs or not pwhash:
+        return False
+    key = tuple(sorted(kwargs.items()))
+    expected = _expected_params.get(key)
+    if expected is None:
+        expected = _expected_params[key] = _hash_params(generate_password_hash('', **kwargs))
+    return _hash_params(pwhash) != expected
+
+
+class _Verifier(object):
+    def __init__(self, workers, queue):
+        self.workers = workers
+        self.queue = queue
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers + queue)
+
+
+_verifier = None
+_verifier_lock = threading.Lock()
+
+
+def _get_verifier():
+    global _verifier
+    config = current_app.config
+    workers = config.get('PASSWORD_VERIFY_WORKERS', 4)
+    queue = config.get('PASSWORD_VERIFY_QUEUE', 16)
+    if _verifier is None or (_verifier.workers, _verifier.queue) != (workers, queue):
+        with _verifier_lock:
+            if _verifier is None or (_verifier.workers, _verifier.queue) != (workers, queue):
+                _verifier = _Verifier(workers, queue)
+    return _verifier
+
+
+def _check(pwhash, password, rehash_options):
+    """在线程池中执行: 验证密码, 需要时按新参数重新hash"""
+    if not check_password_hash(pwhash, password):
+        return False, None
+    if rehash_options is None:
+        return True, None
+    return True, generate_password_hash(password, **rehash_options)
+
+
+def _submit(pwhash, password, rehash_options):
+    verifier = _get_verifier()
+    if not verifier.slots.acquire(timeout=current_app.config.get('PASSWORD_VERIFY_WAIT', 1)):
+        raise PasswordVerifyBusy()
+    try:
+        return verifier.pool.submit(_check, pwhash, password, rehash_options).result()
+    finally:
+        verifier.slots.release()
+
+
+def verify_password(pwhash, password):
+    """在线程池中验证密码, 排队太多时抛出 PasswordVerifyBusy"""
+    if not pwhash:
+        return False
+    return _submit(pwhash, password, None)[0]
+
+
+def verify_and_rehash(pwhash, password):
+    """验证密码, hash参数变化时在同一个线程池中重新hash
+        返回 (是否正确, 新的hash 或 None), 排队太多时抛出 PasswordVerifyBusy
+    """
+    if not pwhash:
+        return False, None
+    return _submit(pwhash, password, _hash_options() if needs_rehash(pwhash) else None)
+
+
+def benchmark(methods, seconds=1.0, password='benchmark-password'):
+    """测试每种hash参数每秒能验证多少次
+        返回 [{'method', 'verifies_per_sec'}]
+    """
+    result = []
+    for method in methods:
+        pwhash = generate_password_hash(password, method=method)
+        count = 0
+        start = time.time()
+        while time.time() - start < seconds:
+            check_password_hash(pwhash, password)
+            count += 1
+        result.append({'method': method,
+                       'verifies_per_sec': count / (time.time() - start)})
+    return result
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""连接池配置和只读副本路由
+    连接池参数: DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE, DB_POOL_PRE_PING,
+    只配置了的参数才传给引擎 (sqlite 等不支持连接池大小的数据库可以不配置).
+    副本: 在 SQLALCHEMY_BINDS 中配置副本库, 把它们的bind名写进 DB_REPLICA_BINDS,
+    只读查询通过 read_query() 轮流发到副本; 当前请求写过数据库, 或者当前用户在
+    DB_READ_AFTER_WRITE_SECONDS 秒内写过数据库时, 仍然读主库, 保证读到自己写的数据.
+    本地可以用两个 sqlite 文件测试:
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///primary.sqlite'
+        SQLALCHEMY_BINDS = {'replica': 'sqlite:///replica.sqlite'}
+        DB_REPLICA_BINDS = ['replica']
+"""
+import time
+import threading
+from itertools import cycle
+
+from flask import current_app, g, session, has_request_context
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from . import db
+
+# 配置名 -> create_engine 的参数
+POOL_OPTIONS = {
+    'DB_POOL_SIZE': 'pool_size',
+    'DB_MAX_OVERFLOW': 'max_overflow',
+    'DB_POOL_RECYCLE': 'pool_recycle',
+    'DB_POOL_PRE_PING': 'pool_pre_ping',
+    'DB_POOL_TIMEOUT': 'pool_timeout',
+}
+
+_pool_counters = {}
+_counters_lock = threading.Lock()
+
+
+def _counters(engine_name):
+    with _counters_lock:
+        return _pool_counters.setdefault(engine_name, {
+            'connects': 0, 'checkouts': 0, 'checkins': 0, 'invalidated': 0})
+
+
+def _count(engine_name, name):
+    counters = _counters(engine_name)
+    with _counters_lock:
+        counters[name] += 1
+
+
+def watch_engine(engine, name):
+    """统计引擎连接池的事件"""
+    if getattr(engine, '_pool_watched', False):
+        return engine
+    engine._pool_watched = True
+    event.listen(engine, 'connect', lambda *args: _count(name, 'connects'))
+    event.listen(engine, 'checkout', lambda *args: _count(name, 'checkouts'))
+    event.listen(engine, 'checkin', lambda *args: _count(name, 'checkins'))
+    event.listen(engine, 'invalidate', lambda *args: _count(name, 'invalidated'))
+    return engine
+
+
+def configure_pool(app):
+    """把 DB_POOL_* 配置转换成引擎参数, 要在第一次连接数据库之前调用"""
+    options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    for key, option in POOL_OPTIONS.items():
+        if app.config.get(key) is not None:
+            options.setdefault(option, app.config[key])
+
+
+def _replica_keys():
+    return current_app.config.get('DB_REPLICA_BINDS') or []
+
+
+class _Replicas(object):
+    """一个应用的副本引擎和会话"""
+
+    def __init__(self, app, keys):
+        self.keys = list(keys)
+        self.sessions = {}
+        for key in self.keys:
+            engine = watch_engine(db.get_engine(app, bind=key), key)
+            self.sessions[key] = scoped_session(sessionmaker(bind=engine))
+        self._cycle = cycle(self.keys)
+        self._lock = threading.Lock()
+
+    def next_session(self):
+        with self._lock:
+            key = next(self._cycle)
+        return self.sessions[key]()
+
+    def remove(self):
+        for s in self.sessions.values():
+            s.remove()
+
+
+def _replicas():
+    app = current_app._get_current_object()
+    replicas = app.extensions.get('db_replicas')
+    keys = _replica_keys()
+    if replicas is None or replicas.keys != list(keys):
+        replicas = app.extensions['db_replicas'] = _Replicas(app, keys)
+    return replicas
+
+
+def _must_use_primary():
+    """当前请求写过数据库, 或者当前用户刚写过数据库"""
+    if not has_request_context():
+        return False
+    if g.get('_db_written'):
+        return True
+    last_write = session.get('_db_last_write')
+    window = current_app.config.get('DB_READ_AFTER_WRITE_SECONDS', 5)
+    return last_write is not None and time.time() - last_write < window
+
+
+def read_session():
+    """返回只读查询使用的会话"""
+    if not _replica_keys() or _must_use_primary():
+        return db.session()
+    return _replicas().next_session()
+
+
+def read_query(model):
+    """返回发到副本的模型查询, 保留模型默认的过滤条件"""
+    return model.query.with_session(read_session())
+
+
+def _after_flush(db_session, flush_context):
+    """记录写操作, 之后的读回到主库"""
+    if has_request_context():
+        g._db_written = True
+        session['_db_last_write'] = time.time()
+
+
+def pool_stats():
+    """各个引擎的连接池状态和事件次数"""
+    result = {}
+    app = current_app._get_current_object()
+    engines = {'primary': db.get_engine(app)}
+    for key in _replica_keys():
+        engines[key] = db.get_engine(app, bind=key)
+    for name, engine in engines.items():
+        stats = dict(_counters(name))
+        stats['status'] = engine.pool.status()
+        if hasattr(engine.pool, 'checkedout'):
+            stats['checked_out'] = engine.pool.checkedout()
+            stats['size'] = engine.pool.size()
+            stats['overflow'] = engine.pool.overflow()
+        result[name] = stats
+    return result
+
+
+def init_app(app):
+    """配置连接池并开始统计, 需要在 db.init_app 之后调用
+        引擎在这里创建并挂上统计, 之后的所有连接都计入 pool_stats
+    """
+    configure_pool(app)
+    watch_engine(db.get_engine(app), 'primary')
+    for key in app.config.get('DB_REPLICA_BINDS') or []:
+        watch_engine(db.get_engine(app, bind=key), key)
+
+    @app.teardown_appcontext
+    def remove_replica_sessions(exception=None):
+        replicas = app.extensions.get('db_replicas')
+        if replicas is not None:
+            replicas.remove()
+
+
+db.event.listen(db.session, 'after_flush', _after_flush)
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""全文检索
+    对案件事实、诉讼请求、事实与理由和批注内容建立倒排索引,
+    索引保存在本地 sqlite 文件 (SEARCH_INDEX_PATH) 中.
+    中文按相邻两个字切分(bigram), 英文和数字按整词切分. 只索引有效记录.
+    数据库提交后通过 session 事件同步更新索引.
+"""
+import re
+import html
+import math
+import sqlite3
+import threading
+
+from flask import current_app
+
+from . import db
+from .models import law_case_info, indictment_bill_info, comment_info, RECORD_ACTIVE
+
+# 检索类型 -> (模型, 主键字段, 建索引的字段)
+SEARCH_TARGETS = {
+    'case': (law_case_info, 'low_case_num', ('low_case_content',)),
+    'bill': (indictment_bill_info, 'bill_num', ('bill_claim', 'bill_fact_and_reason')),
+    'comment': (comment_info, 'comment_num', ('comment_text',)),
+}
+_MODEL_KINDS = dict((target[0], kind) for kind, target in SEARCH_TARGETS.items())
+
+_TOKEN_RE = re.compile(u'[\u3400-\u9fff\uf900-\ufaff]+|[0-9a-z]+')
+_CJK_RE = re.compile(u'[\u3400-\u9fff\uf900-\ufaff]')
+
+# BM25 参数
+K1 = 1.2
+B = 0.75
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    field TEXT NOT NULL,
+    text TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    UNIQUE (kind, key, field)
+);
+CREATE TABLE IF NOT EXISTS postings (
+    token TEXT NOT NULL,
+    doc_id INTEGER NOT NULL,
+    tf INTEGER NOT NULL,
+    PRIMARY KEY (token, doc_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_postings_doc ON postings (doc_id);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta VALUES ('docs', 0), ('length', 0);
+'''
+
+
+def tokenize(text):
+    """把文本切分成检索词, 中文为bigram, 单个汉字保留为unigram"""
+    tokens = []
+    for run in _TOKEN_RE.findall((text or '').lower()):
+        if _CJK_RE.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+class SearchIndex(object):
+    """保存在本地 sqlite 文件中的倒排索引"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _remove(self, conn, kind, key):
+        rows = conn.execute('SELECT id, length FROM docs WHERE kind=? AND key=?',
+                            (kind, key)).fetchall()
+        for doc_id, length in rows:
+            conn.execute('DELETE FROM postings WHERE doc_id=?', (doc_id,))
+            conn.execute('DELETE FROM docs WHERE id=?', (doc_id,))
+            conn.execute("UPDATE meta SET value=value-1 WHERE name='docs'")
+            conn.execute("UPDATE meta SET value=value-? WHERE name='length'", (length,))
+
+    def _add(self, conn, kind, key, field, text):
+        tokens = tokenize(text)
+        if not tokens:
+            return
+        cur = conn.execute(
+            'INSERT INTO docs (kind, key, field, text, length) VALUES (?, ?, ?, ?, ?)',
+            (kind, key, field, text, len(tokens)))
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        conn.executemany('INSERT INTO postings (token, doc_id, tf) VALUES (?, ?, ?)',
+                         [(token, cur.lastrowid, tf) for token, tf in counts.items()])
+        conn.execute("UPDATE meta SET value=value+1 WHERE name='docs'")
+        conn.execute("UPDATE meta SET value=value+? WHERE name='length'", (len(tokens),))
+
+    def apply(self, changes):
+        """批量更新索引
+            changes: {(kind, key): {field: text} 或 None(删除)}
+        """
+        if not changes:
+            return
+        conn = self._connect()
+        with self._write_lock, conn:
+            for (kind, key), fields in changes.items():
+                self._remove(conn, kind, key)
+                for field, text in (fields or {}).items():
+                    self._add(conn, kind, key, field, text)
+
+    def clear(self):
+        conn = self._connect()
+        with self._write_lock, conn:
+            conn.execute('DELETE FROM postings')
+            conn.execute('DELETE FROM docs')
+            conn.execute('UPDATE meta SET value=0')
+
+    def _token_filter(self, conn, tokens):
+        """返回 [(token条件, 参数, idf)], 单个汉字匹配以它开头或结尾的bigram"""
+        total = conn.execute("SELECT value FROM meta WHERE name='docs'").fetchone()[0]
+        result = []
+        for token in sorted(set(tokens)):
+            if len(token) == 1 and _CJK_RE.match(token):
+                cond = ('((p.token >= ? AND p.token < ?) OR '
+                        '(length(p.token) = 2 AND p.token LIKE ?))')
+                args = (token, token + u'\uffff', '_' + token)
+            else:
+                cond, args = 'p.token = ?', (token,)
+            df = conn.execute('SELECT COUNT(*) FROM postings p WHERE ' + cond,
+                              args).fetchone()[0]
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+            result.append((cond, args, idf))
+        return result
+
+    def search(self, query, kinds=None, page=1, per_page=20):
+        """检索, 所有检索词都命中的文档按 BM25 排序
+            返回 {'total', 'page', 'per_page', 'hits': [{'kind', 'key', 'field', 'score', 'snippet'}]}
+        """
+        result = {'total': 0, 'page': page, 'per_page': per_page, 'hits': []}
+        tokens = tokenize(query)
+        if not tokens:
+            return result
+        conn = self._connect()
+        filters = self._token_filter(conn, tokens)
+        meta = dict(conn.execute('SELECT name, value FROM meta'))
+        avg_length = float(meta['length']) / meta['docs'] if meta['docs'] else 1.0
+        parts, args = [], []
+        for i, (cond, cond_args, idf) in enumerate(filters):
+            parts.append('SELECT %d AS q, ? AS idf, p.doc_id, p.tf FROM postings p WHERE %s'
+                         % (i, cond))
+            args.append(idf)
+            args.extend(cond_args)
+        where, where_args = '', []
+        if kinds:
+            where = 'WHERE d.kind IN (%s)' % ','.join('?' * len(kinds))
+            where_args = list(kinds)
+        matched = ('SELECT m.doc_id, SUM(m.idf * m.tf * %(k)s / (m.tf + %(k1)s * (%(b1)s + %(b)s * d.length / ?))) AS score '
+                   'FROM (%(parts)s) m JOIN docs d ON d.id = m.doc_id %(where)s '
+                   'GROUP BY m.doc_id HAVING COUNT(DISTINCT m.q) = ?'
+                   % {'k': K1 + 1, 'k1': K1, 'b1': 1 - B, 'b': B,
+                      'parts': ' UNION ALL '.join(parts), 'where': where})
+        matched_args = [avg_length] + args + where_args + [len(filters)]
+        result['total'] = conn.execute('SELECT COUNT(*) FROM (%s)' % matched,
+                                       matched_args).fetchone()[0]
+        rows = conn.execute(
+            'SELECT d.kind, d.key, d.field, d.text, h.score FROM (%s) h '
+            'JOIN docs d ON d.id = h.doc_id ORDER BY h.score DESC, d.id '
+            'LIMIT ? OFFSET ?' % matched,
+            matched_args + [per_page, (page - 1) * per_page]).fetchall()
+        for kind, key, field, text, score in rows:
+            result['hits'].append({
+                'kind': kind,
+                'key': key,
+                'field': field,
+                'score': round(score, 4),
+                'snippet': make_snippet(text, query),
+            })
+        return result
+
+
+def make_snippet(text, query, width=40):
+    """截取命中位置前后的文本, 命中部分用 <em> 标出"""
+    lowered = text.lower()
+    words = [w for w in _TOKEN_RE.findall(query.lower()) if w]
+    pos, word = -1, ''
+    for w in words:
+        pos = lowered.find(w)
+        if pos >= 0:
+            word = w
+            break
+    if pos < 0:
+        return html.escape(text[:width * 2])
+    start = max(pos - width, 0)
+    end = min(pos + len(word) + width, len(text))
+    return '%s%s<em>%s</em>%s%s' % (
+        '...' if start > 0 else '',
+        html.escape(text[start:pos]),
+        html.escape(text[pos:pos + len(word)]),
+        html.escape(text[pos + len(word):end]),
+        '...' if end < len(text) else '')
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """返回当前应用的索引"""
+    global _index
+    path = current_app.config.get('SEARCH_INDEX_PATH', 'search_index.sqlite')
+    if _index is None or _index.path != path:
+        with _index_lock:
+            if _index is None or _index.path != path:
+                _index = SearchIndex(path)
+    return _index
+
+
+def search(query, kinds=None, page=1, per_page=20):
+    return get_index().search(query, kinds=kinds, page=page, per_page=per_page)
+
+
+def document_fields(obj):
+    """返回记录中需要建索引的字段, 已删除(无效)的记录返回None, 从索引中去掉"""
+    if obj.record_status != RECORD_ACTIVE:
+        return None
+    fields = SEARCH_TARGETS[_MODEL_KINDS[type(obj)]][2]
+    return dict((field, getattr(obj, field)) for field in fields
+                if getattr(obj, field))
+
+
+def reindex(batch_size=1000):
+    """重建整个索引"""
+    index = get_index()
+    index.clear()
+    count = 0
+    for kind, (model, key, fields) in SEARCH_TARGETS.items():
+        query = db.session.query(getattr(model, key), *[getattr(model, f) for f in fields]
+                                 ).filter(model.record_status == RECORD_ACTIVE)
+        changes = {}
+        for row in query.yield_per(batch_size):
+            changes[(kind, row[0])] = dict((f, v) for f, v in zip(fields, row[1:]) if v)
+            if len(changes) >= batch_size:
+                index.apply(changes)
+                count += len(changes)
+                changes = {}
+        index.apply(changes)
+        count += len(changes)
+    return count
+
+
+def _after_flush(session, flush_context):
+    """记录本次事务中需要更新索引的记录, 提交后再写入索引"""
+    pending = session.info.setdefault('search_pending', {})
+    for obj in session.new.union(session.dirty):
+        kind = _MODEL_KINDS.get(type(obj))
+        if kind is None:
+            continue
+        # 软删除/恢复只修改 record_status, 也要更新索引
+        fields = SEARCH_TARGETS[kind][2] + ('record_status',)
+        state = db.inspect(obj)
+        if obj in session.dirty and not any(
+                state.attrs[f].history.has_changes() for f in fields):
+            continue
+        pending[(kind, getattr(obj, SEARCH_TARGETS[kind][1]))] = document_fields(obj)
+    for obj in session.deleted:
+        kind = _MODEL_KINDS.get(type(obj))
+        if kind is not None:
+            pending[(kind, getattr(obj, SEARCH_TARGETS[kind][1]))] = None
+
+
+def _after_commit(session):
+    pending = session.info.pop('search_pending', None)
+    if pending:
+        try:
+            get_index().apply(pending)
+        except Exception:
+            current_app.logger.exception('更新检索索引失败')
+
+
+def _after_rollback(session):
+    session.info.pop('search_pending', None)
+
+
+db.event.listen(db.session, 'after_flush', _after_flush)
+db.event.listen(db.session, 'after_commit', _after_commit)
+db.event.listen(db.session, 'after_rollback', _after_rollback)
+
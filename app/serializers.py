@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""批量序列化
+    每个模型声明一个 Schema, 字段的取值函数在创建时编译好,
+    url 每次批量序列化只调用一次 url_for 生成模板, 日期按值缓存格式化结果,
+    dump_query 直接从查询返回的元组序列化, 不创建ORM对象.
+"""
+from operator import attrgetter, itemgetter
+
+from flask import url_for
+
+from .models import User, Info, Bilu, comment_info, law_case_info, indictment_bill_info
+
+# url 模板中主键的占位值
+_URL_PLACEHOLDER = 918273645546372819
+
+
+class Field(object):
+    """直接输出属性值, convert 对值做转换"""
+
+    def __init__(self, source=None, convert=None):
+        self.source = source
+        self.convert = convert
+
+    def bind(self):
+        """返回本次序列化使用的转换函数"""
+        return self.convert
+
+
+class DateField(Field):
+    """按格式输出日期, 相同的日期只格式化一次"""
+
+    def __init__(self, source=None, format='%Y-%m-%d'):
+        super(DateField, self).__init__(source)
+        self.format = format
+
+    def bind(self):
+        cache = {}
+        fmt = self.format
+
+        def convert(value):
+            if value is None:
+                return None
+            text = cache.get(value)
+            if text is None:
+                text = cache[value] = value.strftime(fmt)
+            return text
+        return convert
+
+
+class UrlField(Field):
+    """由主键生成url, 每次批量序列化只调用一次 url_for"""
+
+    def __init__(self, endpoint, source='id', arg='id', **values):
+        super(UrlField, self).__init__(source)
+        self.endpoint = endpoint
+        self.arg = arg
+        self.values = values
+
+    def bind(self):
+        values = dict(self.values)
+        values[self.arg] = _URL_PLACEHOLDER
+        prefix, _, suffix = url_for(self.endpoint, **values).partition(str(_URL_PLACEHOLDER))
+
+        def convert(value):
+            return '%s%s%s' % (prefix, value, suffix)
+        return convert
+
+
+class Schema(object):
+    """模型的序列化描述
+        fields: [(输出字段名, Field 或 属性名)]
+        brief_exclude: brief 模式下不输出的字段
+    """
+
+    def __init__(self, model, fields, brief_exclude=()):
+        self.model = model
+        self.fields = []
+        for name, field in fields:
+            if not isinstance(field, Field):
+                field = Field(field)
+            if field.source is None:
+                field.source = name
+            self.fields.append((name, field))
+        self.brief_exclude = frozenset(brief_exclude)
+        self._compiled = {}
+
+    def _fields(self, brief):
+        if brief:
+            return [(n, f) for n, f in self.fields if n not in self.brief_exclude]
+        return self.fields
+
+    def _compile(self, brief):
+        """编译对象取值函数, 按 brief 缓存"""
+        compiled = self._compiled.get(brief)
+        if compiled is None:
+            fields = self._fields(brief)
+            compiled = self._compiled[brief] = (
+                [n for n, f in fields],
+                [attrgetter(f.source) for n, f in fields],
+                [f for n, f in fields])
+        return compiled
+
+    def dump_many(self, objs, brief=False):
+        """序列化一组ORM对象"""
+        names, getters, fields = self._compile(brief)
+        converters = [f.bind() for f in fields]
+        plan = list(zip(names, getters, converters))
+        result = []
+        for obj in objs:
+            json_data = {}
+            for name, getter, convert in plan:
+                value = getter(obj)
+                json_data[name] = convert(value) if convert is not None else value
+            result.append(json_data)
+        return result
+
+    def dump(self, obj, brief=False):
+        return self.dump_many([obj], brief=brief)[0]
+
+    def columns(self, brief=False):
+        """查询需要的列, 去掉重复的属性"""
+        sources = []
+        for name, field in self._fields(brief):
+            if field.source not in sources:
+                sources.append(field.source)
+        return sources
+
+    def iter_query(self, query, brief=False, chunk_size=None):
+        """只查询需要的列, 逐行序列化
+            chunk_size: 指定时使用服务端游标按块读取, 内存占用与结果行数无关
+        """
+        sources = self.columns(brief)
+        positions = dict((source, i) for i, source in enumerate(sources))
+        fields = self._fields(brief)
+        plan = [(name, itemgetter(positions[field.source]), field.bind())
+                for name, field in fields]
+        rows = query.with_entities(*[getattr(self.model, s) for s in sources])
+        if chunk_size:
+            rows = rows.execution_options(stream_results=True).yield_per(chunk_size)
+        for row in rows:
+            json_data = {}
+            for name, getter, convert in plan:
+                value = getter(row)
+                json_data[name] = convert(value) if convert is not None else value
+            yield json_data
+
+    def dump_query(self, query, brief=False):
+        """只查询需要的列, 直接从结果元组序列化"""
+        return list(self.iter_query(query, brief=brief))
+
+
+class AvatarField(Field):
+    """由头像hash生成头像url"""
+
+    def __init__(self, source='avatar_hash', **options):
+        super(AvatarField, self).__init__(source)
+        self.options = options
+
+    def bind(self):
+        return User.avatar_url_builder(**self.options)
+
+
+user_schema = Schema(User, [
+    ('id', 'id'),
+    ('username', 'username'),
+    ('email', 'email'),
+    ('phone', 'phone'),
+    ('qq', 'qq'),
+    ('WeChat', 'WeChat'),
+    ('name', 'name'),
+    ('nickname', 'nickname'),
+    ('male', 'male'),
+    ('age', 'age'),
+    ('tops', 'tops'),
+    ('weight', 'weight'),
+    ('position', 'position'),
+    ('about_me', 'about_me'),
+    ('about_me_html', 'about_me_html'),
+    ('avatar_hash', AvatarField()),
+])
+
+user_brief_schema = Schema(User, [
+    ('id', 'id'),
+    ('username', 'username'),
+    ('nickname', 'nickname'),
+    ('position', 'position'),
+    ('about_me', 'about_me'),
+    ('about_me_html', 'about_me_html'),
+    ('auth_url', UrlField('auth.index')),
+    ('avatar_hash', AvatarField()),
+])
+
+info_schema = Schema(Info, [
+    ('id', 'id'),
+    ('user_id', 'user_id'),
+    ('message', 'message'),
+])
+
+bilu_schema = Schema(Bilu, [
+    ('id', 'id'),
+    ('title', 'title'),
+    ('body', 'body'),
+    ('body_html', 'body_html'),
+    ('act_date', DateField()),
+    ('timestamp', 'timestamp'),
+    ('api_url', UrlField('api.delete_bilu')),
+    ('edit_url', UrlField('manage.edit_bilu', _external=True)),
+], brief_exclude=('body', 'body_html'))
+
+_AUDIT_FIELDS = [(name, name) for name in (
+    'record_status', 'create_datetime', 'create_by', 'update_datetime', 'update_by')]
+
+comment_schema = Schema(comment_info, [(name, name) for name in (
+    'low_case_num', 'comment_num', 'comment_entity_type', 'comment_entity_num',
+    'comment_text')] + _AUDIT_FIELDS)
+
+law_case_schema = Schema(law_case_info, [(name, name) for name in (
+    'low_case_num', 'low_case_reason', 'low_case_party', 'low_case_court',
+    'low_case_decision_time', 'low_case_executive_judge',
+    'low_case_defence_counsel', 'low_case_name')] + _AUDIT_FIELDS,
+    brief_exclude=law_case_info.BRIEF_EXCLUDE)
+
+bill_schema = Schema(indictment_bill_info, [(name, name) for name in (
+    'low_case_num', 'bill_num', 'bill_plaintiff', 'bill_demandant',
+    'bill_third_party', 'bill_prosecutor', 'bill_claim',
+    'bill_fact_and_reason')] + _AUDIT_FIELDS,
+    brief_exclude=indictment_bill_info.BRIEF_EXCLUDE)
+
+# 模型 -> Schema
+SCHEMAS = {
+    User: user_schema,
+    Info: info_schema,
+    Bilu: bilu_schema,
+    comment_info: comment_schema,
+    law_case_info: law_case_schema,
+    indictment_bill_info: bill_schema,
+}
+
+
+def serialize(objs_or_query, brief=False, schema=None):
+    """序列化一组对象或一个查询, 查询只取需要的列"""
+    if hasattr(objs_or_query, 'with_entities'):
+        schema = schema or SCHEMAS[objs_or_query.column_descriptions[0]['entity']]
+        return schema.dump_query(objs_or_query, brief=brief)
+    objs = list(objs_or_query)
+    if not objs:
+        return []
+    schema = schema or SCHEMAS[type(objs[0])]
+    return schema.dump_many(objs, brief=brief)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""案件汇总表 case_summary
+    每个有效案件一行: 起诉意见书数、批注数、最新修改时间、法院、判决年份和执行法官,
+    分析页面按法院/年份/法官分组统计时直接查询汇总表, 不再关联三张表.
+    通过消费变更记录增量刷新 (refresh), 也可以全量重建 (rebuild).
+    refresh 和 rebuild 只能由一个进程执行 (flask manage summary-refresh 定时运行),
+    页面只读汇总表.
+"""
+from datetime import datetime
+
+from sqlalchemy.orm import load_only
+
+from . import db
+from . import changefeed
+from .models import (CaseSummary, law_case_info, indictment_bill_info, comment_info,
+                     RECORD_ACTIVE)
+
+CONSUMER = 'case_summary'
+
+# 每次重新计算的案件数
+CHUNK_SIZE = 500
+
+# 分组字段 -> 汇总表的列
+GROUP_FIELDS = {
+    'court': CaseSummary.court,
+    'year': CaseSummary.decision_year,
+    'judge': CaseSummary.judge,
+}
+
+
+def _child_stats(model, keys):
+    """有效记录按案件分组的 (条数, 最新修改时间)"""
+    rows = db.session.query(
+        model.low_case_num, db.func.count(), db.func.max(model.update_datetime)
+    ).filter(model.low_case_num.in_(keys),
+             model.record_status == RECORD_ACTIVE).group_by(model.low_case_num)
+    return dict((num, (count, latest)) for num, count, latest in rows)
+
+
+def _latest(*values):
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+def refresh_cases(keys):
+    """重新计算指定案件的汇总行, 案件不存在或已删除时删除汇总行, 不提交"""
+    keys = list(set(k for k in keys if k is not None))
+    now = datetime.utcnow()
+    for start in range(0, len(keys), CHUNK_SIZE):
+        chunk = keys[start:start + CHUNK_SIZE]
+        cases = law_case_info.query.options(load_only(
+            'low_case_num', 'low_case_court', 'low_case_decision_time',
+            'low_case_executive_judge', 'update_datetime')).filter(
+            law_case_info.low_case_num.in_(chunk)).all()
+        bills = _child_stats(indictment_bill_info, chunk)
+        comments = _child_stats(comment_info, chunk)
+        summaries = dict((s.low_case_num, s) for s in
+                         CaseSummary.query.filter(CaseSummary.low_case_num.in_(chunk)))
+        for case in cases:
+            summary = summaries.pop(case.low_case_num, None)
+            if summary is None:
+                summary = CaseSummary(low_case_num=case.low_case_num)
+                db.session.add(summary)
+            bill_count, bill_latest = bills.get(case.low_case_num, (0, None))
+            comment_count, comment_latest = comments.get(case.low_case_num, (0, None))
+            summary.court = (case.low_case_court or '')[:255]
+            summary.decision_year = (case.low_case_decision_time.year
+                                     if case.low_case_decision_time else None)
+            summary.judge = case.low_case_executive_judge
+            summary.bill_count = bill_count
+            summary.comment_count = comment_count
+            summary.latest_update = _latest(case.update_datetime, bill_latest, comment_latest)
+            summary.refreshed_at = now
+        # 剩下的是已经删除的案件
+        for summary in summaries.values():
+            db.session.delete(summary)
+    return len(keys)
+
+
+def _handle(entries):
+    # 起诉意见书或批注换了案件时, 原案件也要重新计算
+    keys = set()
+    for entry in entries:
+        keys.add(entry.case_num)
+        keys.add(entry.old_case_num)
+    refresh_cases(keys)
+
+
+def refresh(batch_size=500):
+    """处理上次刷新之后的变更, 返回处理的变更数
+        不合并同一行的多次变更, 每次换案件前后的案件都要刷新
+    """
+    return changefeed.consume(CONSUMER, _handle, batch_size=batch_size,
+                              tables=[m.__table__.name for m in changefeed.TRACKED],
+                              collapse=False)
+
+
+def rebuild():
+    """全量重建汇总表, 返回案件数
+        先记下当前的变更位置, 重建期间的变更之后还会再处理一次, 结果相同
+    """
+    seq = changefeed.last_seq()
+    CaseSummary.query.delete(synchronize_session=False)
+    count = 0
+    after = None
+    while True:
+        query = db.session.query(law_case_info.low_case_num).filter(
+            law_case_info.record_status == RECORD_ACTIVE)
+        if after is not None:
+            query = query.filter(law_case_info.low_case_num > after)
+        keys = [row[0] for row in
+                query.order_by(law_case_info.low_case_num).limit(CHUNK_SIZE)]
+        if not keys:
+            break
+        count += refresh_cases(keys)
+        db.session.flush()
+        # 汇总行已经写入, 释放内存
+        db.session.expunge_all()
+        after = keys[-1]
+    changefeed.commit_offset(CONSUMER, seq)
+    db.session.commit()
+    return count
+
+
+def group_by(field, court=None, year=None, limit=100):
+    """按法院/年份/法官分组统计, 可以先按法院或年份过滤
+        返回 [{'key', 'cases', 'bills', 'comments', 'latest_update'}], 按案件数降序
+    """
+    column = GROUP_FIELDS[field]
+    query = db.session.query(
+        column, db.func.count(), db.func.sum(CaseSummary.bill_count),
+        db.func.sum(CaseSummary.comment_count), db.func.max(CaseSummary.latest_update))
+    if court is not None:
+        query = query.filter(CaseSummary.court == court)
+    if year is not None:
+        query = query.filter(CaseSummary.decision_year == year)
+    rows = query.group_by(column).order_by(db.func.count().desc()).limit(limit)
+    return [{'key': key, 'cases': cases, 'bills': int(bills or 0),
+             'comments': int(comments or 0), 'latest_update': latest}
+            for key, cases, bills, comments, latest in rows]
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""token签名和验证
+    每个应用只创建一次签名对象, 支持多个密钥轮换:
+    TOKEN_KEYS = {'key_id': 'secret', ...}, 新token用 TOKEN_CURRENT_KEY 签名,
+    验证时按token头部的 kid 找到对应的密钥. 没有配置时只使用 SECRET_KEY.
+    SECRET_KEY 始终作为 'default' 密钥保留, 轮换前签发的没有 kid 的token用它验证.
+"""
+import json
+import threading
+
+from flask import current_app
+from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from itsdangerous import BadData, BadSignature, SignatureExpired, base64_decode
+
+DEFAULT_KEY = 'default'
+
+# 验证结果
+VALID = 'valid'
+EXPIRED = 'expired'
+BAD_SIGNATURE = 'bad_signature'
+MALFORMED = 'malformed'
+
+
+class TokenService(object):
+    """按密钥id缓存签名对象, 统计各种验证结果的次数"""
+
+    def __init__(self, keys, current_key):
+        self.keys = dict(keys)
+        self.current_key = current_key
+        self._signers = {}
+        self._lock = threading.Lock()
+        self.counters = dict((outcome, 0) for outcome in
+                             (VALID, EXPIRED, BAD_SIGNATURE, MALFORMED))
+
+    @classmethod
+    def from_config(cls, config):
+        configured = config.get('TOKEN_KEYS') or {}
+        keys = dict(configured)
+        keys.setdefault(DEFAULT_KEY, config['SECRET_KEY'])
+        current_key = config.get('TOKEN_CURRENT_KEY') or (
+            sorted(configured)[0] if configured else DEFAULT_KEY)
+        return cls(keys, current_key)
+
+    def _signer(self, kid, expires_in=None):
+        signer = self._signers.get((kid, expires_in))
+        if signer is None:
+            with self._lock:
+                signer = self._signers.get((kid, expires_in))
+                if signer is None:
+                    if expires_in is None:
+                        signer = Serializer(self.keys[kid])
+                    else:
+                        signer = Serializer(self.keys[kid], expires_in=expires_in)
+                    self._signers[(kid, expires_in)] = signer
+        return signer
+
+    def dumps(self, payload, expires_in=3600):
+        """用当前密钥签名"""
+        return self._signer(self.current_key, expires_in).dumps(
+            payload, header_fields={'kid': self.current_key})
+
+    @staticmethod
+    def _kid(token):
+        """不验证签名, 只读取头部的 kid"""
+        if isinstance(token, str):
+            token = token.encode('utf-8')
+        header = json.loads(base64_decode(token.split(b'.', 1)[0]).decode('utf-8'))
+        # 头部必须是对象, kid 必须是字符串, 否则按格式错误处理
+        if not isinstance(header, dict):
+            raise ValueError('token头部不是对象')
+        kid = header.get('kid')
+        if kid is not None and not isinstance(kid, str):
+            raise ValueError('kid 不是字符串')
+        return kid
+
+    def _count(self, outcome):
+        with self._lock:
+            self.counters[outcome] += 1
+
+    def verify(self, token):
+        """验证token, 返回 (payload 或 None, 验证结果)"""
+        try:
+            kid = self._kid(token)
+        except (ValueError, BadData):
+            self._count(MALFORMED)
+            return None, MALFORMED
+        # 没有 kid 的旧token 用 SECRET_KEY 对应的默认密钥验证
+        kid = kid or DEFAULT_KEY
+        if kid not in self.keys:
+            self._count(BAD_SIGNATURE)
+            return None, BAD_SIGNATURE
+        try:
+            payload = self._signer(kid).loads(token)
+        except SignatureExpired:
+            self._count(EXPIRED)
+            return None, EXPIRED
+        except BadSignature:
+            self._count(BAD_SIGNATURE)
+            return None, BAD_SIGNATURE
+        except BadData:
+            self._count(MALFORMED)
+            return None, MALFORMED
+        self._count(VALID)
+        return payload, VALID
+
+    def loads(self, token):
+        """返回token中的数据, 验证失败返回None"""
+        return self.verify(token)[0]
+
+    def verify_many(self, tokens):
+        """批量验证, 返回 [(payload 或 None, 验证结果)]"""
+        return [self.verify(token) for token in tokens]
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+def get_token_service():
+    """返回当前应用的 TokenService, 每个应用只创建一次"""
+    app = current_app._get_current_object()
+    service = app.extensions.get('token_service')
+    if service is None:
+        service = app.extensions.setdefault('token_service', TokenService.from_config(app.config))
+    return service
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""模型层和管理页面的基准测试
+
+    python -m benchmarks run --scale 1k -o results.json
+    python -m benchmarks compare baseline.json results.json --threshold 0.1
+
+默认使用 benchmarks/ 下按规模命名的 sqlite 数据库, 第一次运行时生成数据,
+--database 可以指定其它数据库. 应用配置由 FLASK_CONFIG 环境变量选择.
+"""
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+
+import click
+
+from app import create_app, db
+from . import seed, suite
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_app(database):
+    app = create_app(os.getenv('FLASK_CONFIG') or 'default')
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI=database,
+        SQLALCHEMY_BINDS=None,
+        DB_REPLICA_BINDS=[],
+        SQL_INSTRUMENTATION=False,
+        WTF_CSRF_ENABLED=False,
+        SEARCH_INDEX_PATH=os.path.join(HERE, 'search.sqlite'),
+    )
+    return app
+
+
+@click.group()
+def cli():
+    """模型层和管理页面的基准测试"""
+
+
+@cli.command()
+@click.option('--scale', default='1k', help='1k/100k/1m 或案件数')
+@click.option('--database', default=None, help='数据库url, 默认为 benchmarks/bench-<规模>.sqlite')
+@click.option('--reseed', is_flag=True, help='重新生成数据')
+@click.option('--only', 'names', multiple=True, help='只运行名称以此开头的用例, 可以指定多个')
+@click.option('--rounds', default=5, help='每个用例的计时轮数')
+@click.option('--output', '-o', default=None, help='结果写入json文件')
+def run(scale, database, reseed, names, rounds, output):
+    """生成数据并运行基准测试"""
+    database = database or 'sqlite:///%s' % os.path.join(HERE, 'bench-%s.sqlite' % scale)
+    app = make_app(database)
+    with app.app_context():
+        counts = seed.seed(scale, reseed=reseed,
+                           report=lambda name, count: click.echo('已生成 %s %d 行' % (name, count)))
+        click.echo('数据: %s' % ', '.join('%s %d' % item for item in sorted(counts.items())))
+
+        def report(name, result):
+            click.echo('%-36s %10.4f ms  (min %.4f, %d x %d)' % (
+                name, result['median_ms'], result['min_ms'], result['rounds'], result['number']))
+
+        results = suite.run(app, scale, names=names, rounds=rounds, report=report)
+        db.session.remove()
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        click.echo('结果已写入 %s' % output)
+
+
+@cli.command()
+@click.argument('baseline', type=click.File(encoding='utf-8'))
+@click.argument('current', type=click.File(encoding='utf-8'))
+@click.option('--threshold', default=0.1, help='中位数变慢超过这个比例视为退化')
+def compare(baseline, current, threshold):
+    """比较两次结果, 有退化时返回码为1"""
+    baseline, current = json.load(baseline), json.load(current)
+    if baseline.get('scale') != current.get('scale'):
+        click.echo('警告: 数据规模不同 (%s / %s)' % (baseline.get('scale'), current.get('scale')))
+    if baseline.get('machine') != current.get('machine'):
+        click.echo('警告: 运行环境不同, 结果可能不可比')
+    regressed = 0
+    for name, base, now, change, is_regression in suite.compare(baseline, current, threshold):
+        regressed += is_regression
+        click.echo('%-36s %10.4f -> %10.4f ms  %+7.1f%%%s' % (
+            name, base, now, change * 100, '  退化' if is_regression else ''))
+    if regressed:
+        click.echo('%d 个用例退化超过 %.0f%%' % (regressed, threshold * 100))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
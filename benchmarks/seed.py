@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""生成测试数据
+    按规模写入案件、起诉意见书、批注、笔录、用户和信息, 用批量 insert 直接写表,
+    不经过ORM事件 (变更记录、全文检索等), 审计字段和渲染后的HTML在这里填写.
+    随机数种子固定, 同一规模每次生成的数据相同.
+"""
+import random
+import hashlib
+from datetime import datetime, timedelta
+from itertools import islice
+
+from app import db
+from app.models import (Administrator, User, Info, Bilu, law_case_info,
+                        indictment_bill_info, comment_info, RECORD_ACTIVE,
+                        render_markdown)
+from app.passwords import hash_password
+
+SCALES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+
+# 每批写入的行数
+BATCH_SIZE = 5000
+
+ADMIN_USERNAME = 'bench-admin'
+ADMIN_PASSWORD = 'bench-password'
+USER_PASSWORD = 'bench-password'
+
+SEED = 20190101
+BASE_TIME = datetime(2015, 1, 1)
+
+COURTS = ['第%d中级人民法院' % i for i in range(1, 21)]
+JUDGES = ['J%04d' % i for i in range(200)]
+COUNSELS = ['C%04d' % i for i in range(500)]
+REASONS = ['盗窃', '诈骗', '故意伤害', '交通肇事', '合同纠纷', '非法经营', '寻衅滋事']
+PHRASES = ['经审理查明', '被告人', '于案发当日', '在某市某区', '以非法占有为目的',
+           '公诉机关指控', '上述事实', '有证人证言', '现场勘验笔录', '足以认定',
+           '被害人陈述', '鉴定意见', '本院认为', '依照法律规定', '判决如下']
+
+
+def counts(cases):
+    """每种记录的行数, 以案件数为基准"""
+    people = max(cases // 10, 1)
+    return {
+        'case': cases,
+        'bill': cases * 2,
+        'comment': cases * 3,
+        'bilu': people,
+        'user': people,
+        'info': people * 2,
+    }
+
+
+def case_num(i):
+    return 'BENCH-%07d' % i
+
+
+def bill_num(i, j):
+    return 'BENCH-%07d-B%d' % (i, j)
+
+
+def _text(rng, words):
+    return '，'.join(rng.choice(PHRASES) for _ in range(words)) + '。'
+
+
+def _audit(when):
+    return {'record_status': RECORD_ACTIVE, 'create_datetime': when, 'create_by': 'bench',
+            'update_datetime': when, 'update_by': 'bench'}
+
+
+def _cases(rng, n):
+    for i in range(n):
+        row = {
+            'low_case_num': case_num(i),
+            'low_case_reason': rng.choice(REASONS),
+            'low_case_party': '当事人%d' % i,
+            'low_case_content': _text(rng, 60),
+            'low_case_court': rng.choice(COURTS),
+            'low_case_decision_time': BASE_TIME + timedelta(days=rng.randrange(1800)),
+            'low_case_executive_judge': rng.choice(JUDGES),
+            'low_case_defence_counsel': rng.choice(COUNSELS),
+            'low_case_name': '%s案%d' % (rng.choice(REASONS), i),
+        }
+        row.update(_audit(BASE_TIME + timedelta(minutes=i)))
+        yield row
+
+
+def _bills(rng, cases):
+    for i in range(cases):
+        for j in range(2):
+            row = {
+                'low_case_num': case_num(i),
+                'bill_num': bill_num(i, j),
+                'bill_plaintiff': '原告%d' % i,
+                'bill_demandant': '被告%d' % i,
+                'bill_third_party': None,
+                'bill_prosecutor': '检察官%d' % rng.randrange(100),
+                'bill_claim': _text(rng, 10),
+                'bill_fact_and_reason': _text(rng, 40),
+            }
+            row.update(_audit(BASE_TIME + timedelta(minutes=i, seconds=j)))
+            yield row
+
+
+def _comments(rng, cases):
+    for i in range(cases):
+        for j in range(3):
+            on_case = j == 0
+            row = {
+                'low_case_num': case_num(i),
+                'comment_num': 'BENCH-%07d-C%d' % (i, j),
+                'comment_entity_type': '1' if on_case else '2',
+                'comment_entity_num': case_num(i) if on_case else bill_num(i, j - 1),
+                'comment_text': _text(rng, 8),
+            }
+            row.update(_audit(BASE_TIME + timedelta(minutes=i, seconds=10 + j)))
+            yield row
+
+
+def _bilus(rng, n):
+    for i in range(n):
+        paragraphs = ['## 第%d段\n\n%s' % (p, _text(rng, 30)) for p in range(8)]
+        body = '\n\n'.join(paragraphs)
+        yield {
+            'id': i + 1,
+            'title': '笔录%d' % i,
+            'body': body,
+            'body_html': render_markdown(body),
+            'act_date': BASE_TIME + timedelta(days=rng.randrange(1800)),
+            'timestamp': BASE_TIME + timedelta(minutes=i),
+        }
+
+
+def _users(rng, n):
+    # hash 很慢, 所有用户使用同一个密码hash
+    password_hash = hash_password(USER_PASSWORD)
+    for i in range(n):
+        email = 'bench%d@example.com' % i
+        about_me = _text(rng, 20)
+        yield {
+            'id': 1000 + i,
+            'username': 'bench%d' % i,
+            'email': email,
+            'avatar_hash': hashlib.md5(email.encode('utf-8')).hexdigest(),
+            'password_hash': password_hash,
+            'nickname': '用户%d' % i,
+            'position': rng.choice(['律师', '法官', '检察官']),
+            'about_me': about_me,
+            'about_me_html': render_markdown(about_me),
+            'confirmed': True,
+            'is_admin': False,
+            'unread_count': 2,
+        }
+
+
+def _infos(rng, users):
+    for i in range(users):
+        for j in range(2):
+            yield {
+                'user_id': 1000 + i,
+                'message': '信息%d-%d' % (i, j),
+                'is_read': False,
+                'timestamp': BASE_TIME + timedelta(minutes=i, seconds=j),
+            }
+
+
+def _insert(model, rows):
+    table = model.__table__
+    total = 0
+    while True:
+        batch = list(islice(rows, BATCH_SIZE))
+        if not batch:
+            return total
+        db.session.execute(table.insert(), batch)
+        db.session.commit()
+        total += len(batch)
+
+
+def seeded_counts():
+    """数据库中已有的行数"""
+    return {
+        'case': law_case_info.query.with_inactive().count(),
+        'bill': indictment_bill_info.query.with_inactive().count(),
+        'comment': comment_info.query.with_inactive().count(),
+        'bilu': Bilu.query.count(),
+        'user': User.query.filter(User.id >= 1000).count(),
+        'info': Info.query.count(),
+    }
+
+
+def seed(scale, reseed=False, report=None):
+    """生成指定规模的数据, 已经生成过时直接返回行数
+        scale: SCALES 中的名称或案件数
+    """
+    cases = SCALES[scale] if scale in SCALES else int(scale)
+    expected = counts(cases)
+    if reseed:
+        db.drop_all()
+    db.create_all()
+    if not reseed and seeded_counts() == expected:
+        return expected
+    db.drop_all()
+    db.create_all()
+    rng = random.Random(SEED)
+    admin = Administrator(username=ADMIN_USERNAME)
+    admin.password = ADMIN_PASSWORD
+    db.session.add(admin)
+    db.session.commit()
+    for name, model, rows in (
+            ('case', law_case_info, _cases(rng, cases)),
+            ('bill', indictment_bill_info, _bills(rng, cases)),
+            ('comment', comment_info, _comments(rng, cases)),
+            ('bilu', Bilu, _bilus(rng, expected['bilu'])),
+            ('user', User, _users(rng, expected['user'])),
+            ('info', Info, _infos(rng, expected['user']))):
+        count = _insert(model, rows)
+        if report is not None:
+            report(name, count)
+    return expected
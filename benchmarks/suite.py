@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""基准测试用例和计时
+    每个用例是一个 setup(ctx) 函数, 返回 (被计时的函数, 每次调用包含的操作数),
+    结果按单次操作的毫秒数记录.
+"""
+import os
+import sys
+import time
+import random
+import platform
+from datetime import datetime
+
+import flask
+import sqlalchemy
+from flask import url_for
+
+from app import db
+from app.models import Bilu, User, law_case_info, indictment_bill_info, render_markdown
+from app.serializers import law_case_schema, bill_schema
+from . import seed
+
+# (名称, setup)
+BENCHMARKS = []
+
+# 每次计时至少运行的秒数
+MIN_ROUND_TIME = 0.2
+
+# 每个用例使用的样本数
+SAMPLE_SIZE = 200
+
+# 比较 to_json 和 Schema 批量序列化时使用的行数
+BULK_SAMPLE_SIZE = 10000
+
+
+def benchmark(name):
+    def decorator(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return decorator
+
+
+class Context(object):
+    """用例共享的数据, 在应用上下文中创建"""
+
+    def __init__(self, app, cases):
+        self.app = app
+        self.cases = cases
+        self.rng = random.Random(seed.SEED)
+        self._client = None
+
+    def case_keys(self, n=SAMPLE_SIZE):
+        return [seed.case_num(self.rng.randrange(self.cases)) for _ in range(n)]
+
+    def client(self):
+        """已登录管理员的测试客户端"""
+        if self._client is None:
+            self._client = self.app.test_client()
+            response = login(self._client)
+            if response.status_code != 302:
+                raise RuntimeError('管理员登录失败: %d' % response.status_code)
+        return self._client
+
+    def url(self, endpoint, **values):
+        with self.app.test_request_context():
+            return url_for(endpoint, **values)
+
+
+def login(client):
+    with client.application.test_request_context():
+        url = url_for('manage.login')
+    return client.post(url, data={'username': seed.ADMIN_USERNAME,
+                                  'password': seed.ADMIN_PASSWORD})
+
+
+@benchmark('models.case_to_json')
+def bench_case_to_json(ctx):
+    cases = law_case_info.query.limit(SAMPLE_SIZE).all()
+    return lambda: [case.to_json() for case in cases], len(cases)
+
+
+@benchmark('serializers.case_dump_many')
+def bench_case_dump_many(ctx):
+    cases = law_case_info.query.limit(SAMPLE_SIZE).all()
+    return lambda: law_case_schema.dump_many(cases), len(cases)
+
+
+@benchmark('models.case_to_json_10k')
+def bench_case_to_json_bulk(ctx):
+    cases = law_case_info.query.limit(BULK_SAMPLE_SIZE).all()
+    return lambda: [case.to_json() for case in cases], len(cases)
+
+
+@benchmark('serializers.case_dump_many_10k')
+def bench_case_dump_many_bulk(ctx):
+    cases = law_case_info.query.limit(BULK_SAMPLE_SIZE).all()
+    return lambda: law_case_schema.dump_many(cases), len(cases)
+
+
+@benchmark('models.bill_to_json')
+def bench_bill_to_json(ctx):
+    bills = indictment_bill_info.query.limit(SAMPLE_SIZE).all()
+    return lambda: [bill.to_json() for bill in bills], len(bills)
+
+
+@benchmark('serializers.bill_dump_many')
+def bench_bill_dump_many(ctx):
+    bills = indictment_bill_info.query.limit(SAMPLE_SIZE).all()
+    return lambda: bill_schema.dump_many(bills), len(bills)
+
+
+@benchmark('models.user_to_json')
+def bench_user_to_json(ctx):
+    # easy_to_json 生成url, 需要请求上下文
+    with ctx.app.test_request_context():
+        users = User.query.limit(SAMPLE_SIZE).all()
+
+    def run():
+        with ctx.app.test_request_context():
+            return [user.easy_to_json() for user in users]
+    return run, len(users)
+
+
+@benchmark('models.bilu_render_markdown')
+def bench_render_markdown(ctx):
+    """保存时渲染一次的开销, 即时渲染时每次读取都要付出"""
+    bodies = [bilu.body for bilu in Bilu.query.limit(20)]
+    return lambda: [render_markdown(body) for body in bodies], len(bodies)
+
+
+@benchmark('models.case_update_from_json')
+def bench_case_from_json(ctx):
+    data = [case.to_json() for case in law_case_info.query.limit(SAMPLE_SIZE)]
+
+    def run():
+        for json_data in data:
+            law_case_info().update_from_json(json_data)
+    return run, len(data)
+
+
+@benchmark('models.bill_from_json')
+def bench_bill_from_json(ctx):
+    data = []
+    for bill in indictment_bill_info.query.limit(SAMPLE_SIZE):
+        json_data = bill.to_json()
+        # 没有编号时创建新对象, 不查询数据库
+        json_data.pop('bill_num')
+        data.append(json_data)
+    return lambda: [indictment_bill_info.from_json(d) for d in data], len(data)
+
+
+@benchmark('models.case_queryBy_low_case_num')
+def bench_case_query(ctx):
+    keys = ctx.case_keys()
+
+    def run():
+        for key in keys:
+            law_case_info.queryBy_low_case_num(key)
+        # 不让会话中的对象影响下一次查询
+        db.session.expunge_all()
+    return run, len(keys)
+
+
+@benchmark('models.bill_queryBy_low_case_num')
+def bench_bill_query(ctx):
+    keys = [seed.bill_num(int(key.split('-')[1]), 0) for key in ctx.case_keys()]
+
+    def run():
+        for key in keys:
+            indictment_bill_info.queryBy_low_case_num(key)
+        db.session.expunge_all()
+    return run, len(keys)
+
+
+def _get(ctx, endpoint, **values):
+    client = ctx.client()
+    url = ctx.url(endpoint, **values)
+
+    def run():
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError('%s 返回 %d' % (url, response.status_code))
+    return run, 1
+
+
+@benchmark('views.index')
+def bench_index(ctx):
+    return _get(ctx, 'manage.index')
+
+
+@benchmark('views.cases')
+def bench_cases(ctx):
+    return _get(ctx, 'manage.list_cases', limit=50)
+
+
+@benchmark('views.bills')
+def bench_bills(ctx):
+    return _get(ctx, 'manage.list_bills', limit=50)
+
+
+@benchmark('views.case')
+def bench_case(ctx):
+    return _get(ctx, 'manage.show_case', num=ctx.case_keys(1)[0])
+
+
+@benchmark('views.bilu_timeline')
+def bench_bilu_timeline(ctx):
+    return _get(ctx, 'manage.bilu_timeline_view', id=Bilu.query.first().id)
+
+
+@benchmark('views.login')
+def bench_login(ctx):
+    client = ctx.app.test_client()
+
+    def run():
+        response = login(client)
+        if response.status_code != 302:
+            raise RuntimeError('登录失败: %d' % response.status_code)
+    return run, 1
+
+
+def _time(fn, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return time.perf_counter() - start
+
+
+def measure(fn, ops, rounds=5, min_time=MIN_ROUND_TIME):
+    """先确定每轮调用次数, 使一轮至少运行 min_time 秒, 返回单次操作的毫秒数统计"""
+    number = 1
+    while _time(fn, number) < min_time and number < 1 << 20:
+        number *= 2
+    samples = sorted(_time(fn, number) * 1000 / (number * ops) for _ in range(rounds))
+    return {
+        'rounds': rounds,
+        'number': number,
+        'ops': ops,
+        'min_ms': samples[0],
+        'median_ms': samples[len(samples) // 2],
+        'mean_ms': sum(samples) / len(samples),
+        'max_ms': samples[-1],
+    }
+
+
+def machine_info():
+    return {
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': sys.version.split()[0],
+        'flask': getattr(flask, '__version__', None),
+        'sqlalchemy': sqlalchemy.__version__,
+    }
+
+
+def run(app, scale, names=None, rounds=5, report=None):
+    """运行用例, names 为名称前缀过滤, 返回结果dict"""
+    cases = seed.SCALES[scale] if scale in seed.SCALES else int(scale)
+    ctx = Context(app, cases)
+    results = {}
+    for name, setup in BENCHMARKS:
+        if names and not any(name.startswith(prefix) for prefix in names):
+            continue
+        fn, ops = setup(ctx)
+        results[name] = measure(fn, ops, rounds=rounds)
+        if report is not None:
+            report(name, results[name])
+    return {
+        'started_at': datetime.utcnow().isoformat(),
+        'scale': scale,
+        'counts': seed.counts(cases),
+        'database': app.config['SQLALCHEMY_DATABASE_URI'],
+        'machine': machine_info(),
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold=0.1):
+    """比较两次结果的中位数, 返回 [(名称, 基准ms, 当前ms, 变化比例, 是否退化)]"""
+    rows = []
+    for name, result in sorted(current['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        change = result['median_ms'] / base['median_ms'] - 1 if base['median_ms'] else 0.0
+        rows.append((name, base['median_ms'], result['median_ms'], change, change > threshold))
+    return rows
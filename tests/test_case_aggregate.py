@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import unittest
+from datetime import datetime
+
+from sqlalchemy import event
+
+from app import create_app, db
+from app.models import law_case_info, indictment_bill_info, comment_info
+
+
+class CaseAggregateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.seed()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def seed(self):
+        now = datetime(2019, 1, 1)
+        db.session.add(law_case_info(
+            low_case_num='C1', low_case_reason='盗窃', low_case_party='张三',
+            low_case_content='案件事实', low_case_court='第一中级人民法院',
+            low_case_decision_time=now, low_case_executive_judge='J1',
+            low_case_defence_counsel='L1', low_case_name='张三盗窃案'))
+        for num in ('B1', 'B2', 'B3'):
+            db.session.add(indictment_bill_info(
+                low_case_num='C1', bill_num=num, bill_plaintiff='原告',
+                bill_demandant='被告', bill_prosecutor='检察官',
+                bill_claim='诉讼请求', bill_fact_and_reason='事实与理由'))
+        comments = [('M1', '1', 'C1'), ('M2', '2', 'B1'), ('M3', '2', 'B1'),
+                    ('M4', '2', 'B2'), ('M5', '1', 'C1')]
+        for i, (num, entity_type, entity_num) in enumerate(comments):
+            db.session.add(comment_info(
+                low_case_num='C1', comment_num=num, comment_entity_type=entity_type,
+                comment_entity_num=entity_num, comment_text='批注%s' % num,
+                create_datetime=datetime(2019, 1, 2, 0, 0, i)))
+        db.session.commit()
+
+    def count_queries(self, func):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            result = func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return result, statements
+
+    def test_load_aggregate_uses_three_queries(self):
+        aggregate, statements = self.count_queries(
+            lambda: law_case_info.load_aggregate('C1'))
+        self.assertEqual(len(statements), 3)
+        self.assertEqual(aggregate['case']['low_case_num'], 'C1')
+        self.assertEqual([b['bill_num'] for b in aggregate['bills']], ['B1', 'B2', 'B3'])
+
+    def test_comments_grouped_by_entity(self):
+        aggregate = law_case_info.load_aggregate('C1')
+        groups = [(g['entity_type'], g['entity_num'], [c['comment_num'] for c in g['comments']])
+                  for g in aggregate['comments']]
+        self.assertEqual(groups, [
+            ('1', 'C1', ['M1', 'M5']),
+            ('2', 'B1', ['M2', 'M3']),
+            ('2', 'B2', ['M4']),
+        ])
+
+    def test_missing_case(self):
+        aggregate, statements = self.count_queries(
+            lambda: law_case_info.load_aggregate('NOPE'))
+        self.assertIsNone(aggregate)
+        self.assertEqual(len(statements), 1)